@@ -1,153 +1,165 @@
-import json
-import os
-import requests
-import tempfile
-import sqlite3
-from pydantic import BaseModel, parse_obj_as
-from models import Airport
+from types import MappingProxyType
+from typing import Iterable, Mapping, Sequence
 
+import numpy as np
 
-AIRPORTS_JSON = "https://gist.githubusercontent.com/tdreyno/4278655/raw/7b0762c09b519f40397e4c3e100b097d861f5588/airports.json"
-
-WORKING_DIR = os.path.join(tempfile.gettempdir(), "layover-party")
-AIRPORTS_DB = os.path.join(WORKING_DIR, "airports.db")
-
-AIRPORTS_SCHEMA = """
-    CREATE TABLE IF NOT EXISTS airports (
-        iata TEXT PRIMARY KEY,
-        name TEXT,
-        city TEXT,
-        state TEXT,
-        country TEXT,
-        lat REAL,
-        long REAL
-    );
-    
-    CREATE INDEX IF NOT EXISTS airports_name ON airports (name);
-    CREATE INDEX IF NOT EXISTS airports_city ON airports (lat, long);
-"""
-
-
-class __airport(BaseModel):
-    code: str
-    lat: str
-    lon: str
-    name: str
-    city: str
-    state: str | None
-    country: str
-    woeid: int
-    tz: str
-    phone: str
-    type: str
-    email: str
-    url: str
-    icao: str
-    direct_flights: int
-    carriers: int
-
-
-def __download_airports_json() -> list[__airport]:
-    res = requests.get(AIRPORTS_JSON)
-    res.raise_for_status()
-    return parse_obj_as(list[__airport], res.json())
-
-
-def __init_db() -> sqlite3.Connection:
-    os.makedirs(WORKING_DIR, exist_ok=True)
-
-    db = sqlite3.connect(AIRPORTS_DB, check_same_thread=False)
-
-    cur = db.cursor()
-    cur.executescript(AIRPORTS_SCHEMA)
-
-    res = cur.execute("SELECT COUNT(*) FROM airports")
-    if res.fetchone()[0] == 0:
-        print("Downloading airports.json...")
-        airports = __download_airports_json()
-
-        print("Inserting airports into database...")
-        cur.executemany(
-            "INSERT INTO airports VALUES (?, ?, ?, ?, ?, ?, ?)",
-            [
-                (
-                    airport.code,
-                    airport.name,
-                    airport.city,
-                    airport.state,
-                    airport.country,
-                    airport.lat,
-                    airport.lon,
-                )
-                for airport in airports
-            ],
-        )
-
-    db.commit()
-    return db
-
-
-db = __init_db()
-
-
-def find_by_coords(lat: float, long: float, limit=10) -> list[Airport]:
-    cur = db.cursor()
-    res = cur.execute(
-        "SELECT * FROM airports ORDER BY (lat - ?) * (lat - ?) + (long - ?) * (long - ?) LIMIT ?",
-        (lat, lat, long, long, limit),
+from models import Airport
+from kdtree import KDTree
+from textsearch import SearchIndex
+from airports_snapshot import load_snapshot
+
+
+class Registry:
+    """
+    An immutable in-memory view of the airport dataset. Every airport is built
+    once when the registry is loaded and then shared by all lookups.
+    """
+
+    __slots__ = (
+        "airports",
+        "by_iata",
+        "_codes",
+        "_degrees",
+        "_radians",
+        "_spatial",
+        "_search",
     )
 
-    rows = res.fetchall()
-    return [
-        Airport(
-            iata=row[0],
-            name=row[1],
-            city=row[2],
-            state=row[3],
-            country=row[4],
-            lat=row[5],
-            long=row[6],
-        )
-        for row in rows
-    ]
+    airports: tuple[Airport, ...]
+    by_iata: Mapping[str, Airport]
+    _codes: tuple[np.ndarray, np.ndarray] | None
+    _degrees: np.ndarray | None
+    _radians: np.ndarray | None
+    _spatial: KDTree[Airport] | None
+    _search: SearchIndex[Airport] | None
+
+    def __init__(self, airports: Iterable[Airport]):
+        self.airports = tuple(airports)
+        self.by_iata = MappingProxyType({a.iata: a for a in self.airports})
+        # The indexes are built on first use to keep startup fast.
+        self._codes = None
+        self._degrees = None
+        self._radians = None
+        self._spatial = None
+        self._search = None
+
+    @property
+    def degrees(self) -> np.ndarray:
+        """
+        The (lat, long) of every airport in degrees, as an (n, 2) array in the
+        same order as airports.
+        """
+        if self._degrees is None:
+            self._degrees = np.array(
+                [(a.lat, a.long) for a in self.airports], dtype=np.float64
+            ).reshape(-1, 2)
+            self._degrees.flags.writeable = False
+        return self._degrees
+
+    @property
+    def radians(self) -> np.ndarray:
+        """
+        Same as degrees, in radians.
+        """
+        if self._radians is None:
+            self._radians = np.radians(self.degrees)
+            self._radians.flags.writeable = False
+        return self._radians
+
+    def positions(self, iatas: Sequence[str]) -> np.ndarray:
+        """
+        Returns the position in airports of the airport with each of the given
+        IATA codes, or -1 for codes that aren't known, as an array.
+        """
+        if self._codes is None:
+            codes = np.array([a.iata for a in self.airports], dtype=str)
+            order = np.argsort(codes, kind="stable")
+            self._codes = (codes[order], order)
+
+        codes, order = self._codes
+        if not iatas or not len(codes):
+            return np.full(len(iatas), -1, dtype=np.intp)
+
+        query = np.array(iatas, dtype=str)
+        i = np.minimum(np.searchsorted(codes, query), len(codes) - 1)
+        return np.where(codes[i] == query, order[i], -1)
+
+    @property
+    def spatial(self) -> KDTree[Airport]:
+        if self._spatial is None:
+            self._spatial = KDTree((a.lat, a.long, a) for a in self.airports)
+        return self._spatial
+
+    @property
+    def search(self) -> SearchIndex[Airport]:
+        if self._search is None:
+            self._search = SearchIndex(
+                (a, a.iata, (a.city, a.name)) for a in self.airports
+            )
+        return self._search
+
+    def __len__(self) -> int:
+        return len(self.airports)
+
+
+def __load_registry() -> Registry:
+    return Registry(load_snapshot())
+
+
+registry = __load_registry()
+
+
+def reload() -> Registry:
+    """
+    Reloads the registry from the airport snapshot. Call this after the
+    snapshot is rebuilt; lookups already in flight keep using the old registry.
+    """
+    global registry
+    registry = __load_registry()
+    return registry
+
+
+def find_by_coords(
+    lat: float,
+    long: float,
+    limit=10,
+    radius: float | None = None,
+) -> list[tuple[Airport, float]]:
+    """
+    Finds the airports closest to the given coordinates by great-circle
+    distance, optionally only those within radius kilometers. Returns
+    (airport, distance in km) pairs, closest first.
+    """
+    return registry.spatial.nearest(lat, long, limit, max_km=radius)
+
+
+def find_in_box(
+    min_lat: float,
+    min_long: float,
+    max_lat: float,
+    max_long: float,
+) -> list[Airport]:
+    """
+    Finds the airports inside the given box. Boxes across the antimeridian
+    have min_long greater than max_long.
+    """
+    lat, long = registry.degrees.T
+    inside = (lat >= min_lat) & (lat <= max_lat)
+    if min_long <= max_long:
+        inside &= (long >= min_long) & (long <= max_long)
+    else:
+        inside &= (long >= min_long) | (long <= max_long)
+    return [registry.airports[i] for i in np.flatnonzero(inside)]
 
 
 def find_by_name(name: str, limit=10) -> list[Airport]:
-    cur = db.cursor()
-    res = cur.execute(
-        "SELECT * FROM airports WHERE name LIKE ? OR iata LIKE ? OR city LIKE ? LIMIT ?",
-        (f"%{name}%", f"%{name}%", f"%{name}%", limit),
-    )
-
-    rows = res.fetchall()
-    return [
-        Airport(
-            iata=row[0],
-            name=row[1],
-            city=row[2],
-            state=row[3],
-            country=row[4],
-            lat=row[5],
-            long=row[6],
-        )
-        for row in rows
-    ]
+    """
+    Searches airports by IATA code, city and name. Exact IATA matches come
+    first, then prefix matches, then substring matches, then fuzzy matches.
+    """
+    return registry.search.search(name, limit)
 
 
 def get_by_iata(iata: str) -> Airport | None:
-    cur = db.cursor()
-    res = cur.execute("SELECT * FROM airports WHERE iata = ?", (iata,))
-
-    row = res.fetchone()
-    if row is None:
-        return None
-
-    return Airport(
-        iata=row[0],
-        name=row[1],
-        city=row[2],
-        state=row[3],
-        country=row[4],
-        lat=row[5],
-        long=row[6],
-    )
+    return registry.by_iata.get(iata)
+
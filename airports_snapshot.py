@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import struct
+from array import array
+
+from models import Airport
+
+
+AIRPORTS_JSON = "https://gist.githubusercontent.com/tdreyno/4278655/raw/7b0762c09b519f40397e4c3e100b097d861f5588/airports.json"
+
+# Source of the shipped snapshot, in the same format as AIRPORTS_JSON. It was
+# made from the airportsdata package with `python airports_snapshot.py
+# airportsdata`, since it has more airports with IATA codes than the gist.
+AIRPORTS_SOURCE = "data/airports.json"
+AIRPORTSDATA_VERSION = "20260905"
+
+# Prebuilt snapshot of AIRPORTS_SOURCE, regenerated with
+# `python airports_snapshot.py`.
+AIRPORTS_PATH = os.environ.get("AIRPORTS_PATH", "data/airports.bin")
+
+# The snapshot is laid out as:
+#
+#   header:  magic, version, number of airports (n)
+#   coords:  n * 2 float64s, lat and long of each airport
+#   strings: n * 5 NUL-separated UTF-8 strings, the iata, name, city, state
+#            and country of each airport (an empty state means None)
+#
+# so loading it is one read, one array copy and one split.
+SNAPSHOT_MAGIC = b"LPAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHI")
+SNAPSHOT_FIELDS = 5
+
+
+def build_snapshot(airports: list[dict], path: str = AIRPORTS_PATH) -> int:
+    """
+    Writes the given airports, in the format of AIRPORTS_JSON, into a snapshot
+    at path. Returns the number of airports written.
+    """
+    airports = sorted(airports, key=lambda a: a["code"])
+
+    coords = array("d")
+    strings: list[str] = []
+    for a in airports:
+        coords.extend((float(a["lat"]), float(a["lon"])))
+        strings.extend(
+            (a["code"], a["name"], a["city"], a.get("state") or "", a["country"])
+        )
+
+    if any("\0" in s for s in strings):
+        raise ValueError("airport strings must not contain NUL")
+
+    if sys.byteorder != "little":
+        coords.byteswap()
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(airports)))
+        f.write(coords.tobytes())
+        f.write("\0".join(strings).encode())
+    os.replace(tmp, path)
+
+    return len(airports)
+
+
+def convert_airportsdata() -> list[dict]:
+    """
+    Returns the airports with IATA codes in the airportsdata package, in the
+    format of AIRPORTS_JSON. Needs airportsdata==AIRPORTSDATA_VERSION and
+    pycountry, which aren't dependencies otherwise.
+    """
+    import airportsdata
+    import pycountry
+
+    airports = []
+    for code, a in sorted(airportsdata.load("IATA").items()):
+        # airportsdata has ISO country codes; the gist has country names.
+        country = pycountry.countries.get(alpha_2=a["country"])
+        airports.append(
+            {
+                "code": code,
+                "name": a["name"],
+                "city": a["city"] or "",
+                "state": a["subd"] or None,
+                "country": (
+                    getattr(country, "common_name", None) or country.name
+                    if country is not None
+                    else a["country"]
+                ),
+                "lat": a["lat"],
+                "lon": a["lon"],
+            }
+        )
+    return airports
+
+
+def load_snapshot(path: str = AIRPORTS_PATH) -> list[Airport]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"airport snapshot {path} not found, run `python airports_snapshot.py`"
+        )
+
+    magic, version, n = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+
+    offset = SNAPSHOT_HEADER.size
+    coords = array("d")
+    coords.frombytes(data[offset : offset + n * 2 * coords.itemsize])
+    if sys.byteorder != "little":
+        coords.byteswap()
+
+    offset += n * 2 * coords.itemsize
+    strings = data[offset:].decode().split("\0")
+    assert len(strings) == n * SNAPSHOT_FIELDS
+
+    # The snapshot was validated when it was built, so skip pydantic's
+    # validation here; it is most of the cost of loading otherwise.
+    return [
+        Airport.construct(
+            iata=strings[i * SNAPSHOT_FIELDS],
+            name=strings[i * SNAPSHOT_FIELDS + 1],
+            city=strings[i * SNAPSHOT_FIELDS + 2],
+            state=strings[i * SNAPSHOT_FIELDS + 3] or None,
+            country=strings[i * SNAPSHOT_FIELDS + 4],
+            lat=coords[i * 2],
+            long=coords[i * 2 + 1],
+        )
+        for i in range(n)
+    ]
+
+
+if __name__ == "__main__":
+    # With no arguments, rebuilds the snapshot from AIRPORTS_SOURCE. Given a
+    # path or URL of a file in the format of AIRPORTS_JSON, builds it from
+    # that instead. `airportsdata` regenerates AIRPORTS_SOURCE first.
+    source = sys.argv[1] if len(sys.argv) > 1 else AIRPORTS_SOURCE
+    if source == "airportsdata":
+        airports = convert_airportsdata()
+        with open(AIRPORTS_SOURCE, "w") as f:
+            json.dump(airports, f, ensure_ascii=False, separators=(",", ":"))
+            f.write("\n")
+        print(f"Wrote {len(airports)} airports to {AIRPORTS_SOURCE}")
+    elif source.startswith("https://") or source.startswith("http://"):
+        import requests
+
+        print(f"Downloading {source}...")
+        res = requests.get(source)
+        res.raise_for_status()
+        airports = res.json()
+    else:
+        with open(source) as f:
+            airports = json.load(f)
+
+    n = build_snapshot(airports)
+    print(f"Wrote {n} airports to {AIRPORTS_PATH}")
@@ -0,0 +1,145 @@
+"""
+Compares the cache record formats on flight detail responses, which are
+nearly everything the cache stores since searches got rows of their own: the
+original format, with JSON text keys and plain responses, against hashed keys
+and responses compressed without a dictionary and with each trained
+dictionary in data/. Reports average sizes and encode, decode, SQLite write
+and SQLite read latencies over distinct details made from the example one.
+
+Run from the repository root:
+
+    python -m bench.cache_format
+"""
+
+import json
+import zlib
+import random
+import sqlite3
+import timeit
+from datetime import timedelta
+
+import httputil
+from models import FlightDetailResponse
+
+ROWS = 200
+
+# Stops to route the example's legs through instead, so that the details
+# don't all repeat the same airports.
+STOPS = [
+    ("15093", "Oslo Gardermoen", "OSL", "Oslo"),
+    ("9451", "Copenhagen", "CPH", "Copenhagen"),
+    ("11616", "Reykjavik Keflavik", "KEF", "Reykjavik"),
+    ("10413", "Dublin", "DUB", "Dublin"),
+    ("16574", "Amsterdam Schiphol", "AMS", "Amsterdam"),
+    ("9828", "Frankfurt am Main", "FRA", "Frankfurt"),
+]
+
+
+def varied(detail: FlightDetailResponse, n: int) -> list[str]:
+    # Vary what varies between real details so that repeats of the same one
+    # don't make compression look better than it is.
+    rng = random.Random(n)
+    responses = []
+    for i in range(n):
+        shift = timedelta(minutes=rng.randrange(-12 * 60, 12 * 60, 5))
+        stop = dict(zip(("id", "name", "displayCode", "city"), rng.choice(STOPS)))
+
+        data = detail.copy(deep=True)
+        assert data.data is not None and data.data.legs is not None
+        for leg in data.data.legs:
+            leg.id = f"{leg.id}-{rng.randrange(10**6)}"
+            leg.departure += shift
+            leg.arrival += shift
+            for segment in leg.segments or []:
+                segment.id = f"{segment.id}-{rng.randrange(10**6)}"
+                segment.flightNumber = str(rng.randrange(100, 9999))
+                segment.departure += shift
+                segment.arrival += shift
+                if segment.destination.displayCode == "OSL":
+                    segment.destination = segment.destination.copy(update=stop)
+                if segment.origin.displayCode == "OSL":
+                    segment.origin = segment.origin.copy(update=stop)
+            for layover in leg.layovers or []:
+                layover.origin = layover.origin.copy(update=stop)
+                layover.destination = layover.destination.copy(update=stop)
+                layover.duration = rng.randrange(45, 8 * 60)
+        data.timestamp = rng.randrange(1_670_000_000_000, 1_700_000_000_000)
+        data.data.pop_score = rng.randrange(0, 50)
+        responses.append(data.json())
+    return responses
+
+
+def with_dict(version: int):
+    with open(httputil.ZDICT_PATH.format(version), "rb") as f:
+        zdict = f.read()
+
+    def encode(response: str) -> bytes:
+        c = zlib.compressobj(httputil.ZLIB_LEVEL, zdict=zdict)
+        return c.compress(response.encode()) + c.flush()
+
+    return encode, lambda d: httputil.decode(version, d)
+
+
+def per_call(fn, number=20) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def sqlite_latency(keys: list, values: list) -> tuple[float, float]:
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+
+    def write():
+        db.executemany("REPLACE INTO cache VALUES (?, ?)", zip(keys, values))
+        db.commit()
+
+    def read():
+        for key in keys:
+            db.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+
+    write()
+    return per_call(write, 5) / len(keys), per_call(read, 5) / len(keys)
+
+
+if __name__ == "__main__":
+    with open("data/flight_detail_response_example.json") as f:
+        detail = FlightDetailResponse.parse_raw(f.read())
+
+    responses = varied(detail, ROWS)
+    keys = [
+        {"itineraryId": f"{i:04}", "origin": "LHR", "dest": "EWR", "date": "2030-01-01"}
+        for i in range(ROWS)
+    ]
+    for response in responses:
+        assert httputil.decode(httputil.FORMAT_VERSION, httputil.encode(response)) == response
+
+    formats = {
+        "text": (lambda r: r, lambda d: d, [json.dumps(k) for k in keys]),
+        "zlib": (
+            lambda r: zlib.compress(r.encode(), httputil.ZLIB_LEVEL),
+            lambda d: zlib.decompress(d).decode(),
+            [httputil.digest(k) for k in keys],
+        ),
+    }
+    for version in range(1, httputil.FORMAT_VERSION + 1):
+        encode, decode = with_dict(version)
+        formats[f"zlib+v{version}"] = (encode, decode, [httputil.digest(k) for k in keys])
+
+    size = sum(len(r) for r in responses) / ROWS
+    print(f"{ROWS} details, {size:.0f} bytes each on average")
+    print(
+        f"{'format':>10} {'bytes':>8} {'ratio':>6}"
+        f" {'encode':>9} {'decode':>9} {'write':>9} {'read':>9}"
+    )
+
+    for label, (encode, decode, dbkeys) in formats.items():
+        data = [encode(r) for r in responses]
+        enc = per_call(lambda: [encode(r) for r in responses]) / ROWS
+        dec = per_call(lambda: [decode(d) for d in data]) / ROWS
+        write, read = sqlite_latency(dbkeys, data)
+        stored = sum(len(d) for d in data) / ROWS
+
+        print(
+            f"{label:>10} {stored:>8.0f} {size / stored:>6.1f}"
+            f" {enc * 1e6:>7.1f}µs {dec * 1e6:>7.1f}µs"
+            f" {write * 1e6:>7.1f}µs {read * 1e6:>7.1f}µs"
+        )
@@ -0,0 +1,105 @@
+"""
+Benchmarks flights.layover_score against the original implementation, which
+looked both airports of every stop pair up in SQLite and computed the distance
+from scratch.
+
+Run from the repository root:
+
+    python -m bench.layover_score
+"""
+
+import math
+import sqlite3
+import timeit
+
+import airports
+import flights
+from models import Airport, FlightApiResponse
+
+N = 2000
+
+# The airports table that get_by_iata used to query.
+db = sqlite3.connect(":memory:")
+db.execute(
+    """
+    CREATE TABLE airports (
+        iata TEXT PRIMARY KEY,
+        name TEXT,
+        city TEXT,
+        state TEXT,
+        country TEXT,
+        lat REAL,
+        long REAL
+    )
+    """
+)
+db.executemany(
+    "INSERT INTO airports VALUES (?, ?, ?, ?, ?, ?, ?)",
+    [
+        (a.iata, a.name, a.city, a.state, a.country, a.lat, a.long)
+        for a in airports.registry.airports
+    ],
+)
+
+
+def sqlite_get_by_iata(iata: str) -> Airport | None:
+    cur = db.cursor()
+    res = cur.execute("SELECT * FROM airports WHERE iata = ?", (iata,))
+
+    row = res.fetchone()
+    if row is None:
+        return None
+
+    return Airport(
+        iata=row[0],
+        name=row[1],
+        city=row[2],
+        state=row[3],
+        country=row[4],
+        lat=row[5],
+        long=row[6],
+    )
+
+
+def sqlite_layover_score(leg) -> float:
+    flight_distance = 0
+    for a, b in flights.stop_pairs(leg):
+        stop1_airport = sqlite_get_by_iata(a)
+        stop2_airport = sqlite_get_by_iata(b)
+        assert stop1_airport is not None
+        assert stop2_airport is not None
+
+        flight_distance += flights.calculate_distance(
+            (stop1_airport.lat, stop1_airport.long),
+            (stop2_airport.lat, stop2_airport.long),
+        )
+
+    flight_time = flight_distance / flights.plane_speed(flight_distance)
+    total_duration = (leg.arrival - leg.departure).total_seconds() / 3600
+    return total_duration - flight_time
+
+
+def bench(label: str, layover_score, legs) -> float:
+    def run():
+        for leg in legs:
+            layover_score(leg)
+
+    t = min(timeit.repeat(run, number=N, repeat=5)) / (N * len(legs))
+    print(f"{label:>10}: {t * 1e6:8.2f} µs/leg")
+    return t
+
+
+if __name__ == "__main__":
+    with open("data/flight_response_example.json") as f:
+        search = FlightApiResponse.parse_raw(f.read())
+
+    assert search.data is not None
+    legs = [leg for flight in search.data for leg in flight.legs or []]
+
+    for leg in legs:
+        assert math.isclose(sqlite_layover_score(leg), flights.layover_score(leg))
+
+    before = bench("sqlite", sqlite_layover_score, legs)
+    after = bench("current", flights.layover_score, legs)
+
+    print(f"{'speedup':>10}: {before / after:8.2f}x")
@@ -0,0 +1,275 @@
+"""
+Drives a running backend with a mix of what the app does: logging in,
+searching, paging through results, adding and removing layovers and looking
+up who else is in a layover. Requests arrive at a fixed average rate whether
+or not earlier ones are done, like real users would. Reports p50, p95 and p99
+latencies and throughput for each kind of request, and, if the backend is
+pointed at bench/stub_rapidapi.py, how many upstream calls it made.
+
+Run from the repository root with the stub and the backend already up:
+
+    python -m bench.stub_rapidapi &
+    RAPID_API_URL=http://127.0.0.1:8090/api/v1 ./run.sh &
+    python -m bench.loadtest --rps 20 --duration 60
+"""
+
+import time
+import random
+import asyncio
+import argparse
+from datetime import date as Date, datetime, timedelta
+
+from aiohttp import ClientSession, ClientTimeout
+
+from bench.stub_rapidapi import STOPS
+
+ROUTES = [("LHR", "EWR"), ("SFO", "NRT"), ("LAX", "CDG"), ("SIN", "ZRH")]
+
+# Relative weights of each kind of request.
+MIX = {
+    "search": 30,
+    "page": 20,
+    "add_layover": 15,
+    "remove_layover": 10,
+    "match": 20,
+    "login": 5,
+}
+
+
+class User:
+    def __init__(self, email: str):
+        self.email = email
+        self.token = ""
+        self.cursor: str | None = None
+        self.search: dict | None = None
+        self.layovers: list[dict] = []
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": "Bearer " + self.token}
+
+
+class Results:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {op: [] for op in MIX}
+        self.errors: dict[str, dict[int, int]] = {op: {} for op in MIX}
+
+    def record(self, op: str, status: int, seconds: float):
+        if status >= 400:
+            self.errors[op][status] = self.errors[op].get(status, 0) + 1
+        else:
+            self.latencies[op].append(seconds)
+
+    def report(self, elapsed: float):
+        def percentile(ordered: list[float], p: float) -> float:
+            if not ordered:
+                return float("nan")
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+        print(f"{'op':<16} {'ok':>6} {'errors':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        every = []
+        for op, samples in self.latencies.items():
+            ordered = sorted(samples)
+            every.extend(ordered)
+            errors = sum(self.errors[op].values())
+            print(
+                f"{op:<16} {len(ordered):>6} {errors:>8} "
+                f"{percentile(ordered, 0.50):>9.1f} "
+                f"{percentile(ordered, 0.95):>9.1f} "
+                f"{percentile(ordered, 0.99):>9.1f}"
+            )
+            if errors:
+                print(f"{'':<16} {self.errors[op]}")
+
+        every.sort()
+        print(
+            f"{'all':<16} {len(every):>6} "
+            f"{sum(sum(e.values()) for e in self.errors.values()):>8} "
+            f"{percentile(every, 0.50):>9.1f} "
+            f"{percentile(every, 0.95):>9.1f} "
+            f"{percentile(every, 0.99):>9.1f}"
+        )
+        print(f"throughput: {len(every) / elapsed:.1f} ok requests/s over {elapsed:.1f}s")
+
+
+async def setup(http: ClientSession, url: str, users: int, password: str) -> list[User]:
+    # The same accounts are used every run, so registering them (10 a minute
+    # at most) is only slow the first time.
+    made = [User(f"loadtest-{i}@example.com") for i in range(users)]
+
+    async def login(user: User) -> bool:
+        async with http.post(
+            url + "/api/login",
+            json={"email": user.email, "password": password},
+        ) as res:
+            if res.status == 401:
+                return False
+            res.raise_for_status()
+            user.token = (await res.json())["token"]
+            return True
+
+    logged_in = await asyncio.gather(*(login(u) for u in made))
+    missing = [u for u, ok in zip(made, logged_in) if not ok]
+    if missing:
+        print(f"registering {len(missing)} users...")
+
+    for user in missing:
+        while True:
+            async with http.post(
+                url + "/api/register",
+                json={"email": user.email, "password": password, "first_name": "Load"},
+            ) as res:
+                if res.status == 429:
+                    await asyncio.sleep(float(res.headers.get("Retry-After", 6)))
+                    continue
+                if res.status not in (204, 409):
+                    raise RuntimeError(
+                        f"register {user.email}: {res.status} {await res.text()}"
+                    )
+                break
+
+        if not await login(user):
+            raise RuntimeError(f"login {user.email}: wrong --password for existing user")
+
+    return made
+
+
+async def do(
+    http: ClientSession,
+    args,
+    rng: random.Random,
+    user: User,
+    op: str,
+) -> int:
+    """
+    Makes one request of the given kind as the user and returns its status.
+    """
+    url = args.url
+
+    if op == "page" and user.cursor is None:
+        op = "search"
+    if op == "remove_layover" and not user.layovers:
+        op = "add_layover"
+
+    if op == "login":
+        async with http.post(
+            url + "/api/login",
+            json={"email": user.email, "password": args.password},
+        ) as res:
+            if res.ok:
+                user.token = (await res.json())["token"]
+            return res.status
+
+    if op == "search":
+        origin, dest = rng.choice(ROUTES)
+        day = Date.today() + timedelta(days=rng.randrange(30, 30 + args.dates))
+        user.search = {
+            "origin": origin,
+            "dest": dest,
+            "date": day.isoformat(),
+            "return_date": (day + timedelta(days=7)).isoformat(),
+        }
+        params = user.search
+    elif op == "page":
+        assert user.search is not None and user.cursor is not None
+        params = {**user.search, "cursor": user.cursor}
+
+    if op in ("search", "page"):
+        async with http.get(url + "/api/flights", params=params, headers=user.headers) as res:
+            await res.read()
+            user.cursor = res.headers.get("X-Next-Cursor")
+            return res.status
+
+    if op == "add_layover":
+        arrive = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(
+            hours=rng.randrange(24, 24 * args.dates)
+        )
+        layover = {
+            "iata": rng.choice(STOPS),
+            "arrive": arrive.isoformat(),
+            "depart": (arrive + timedelta(hours=rng.randrange(2, 12))).isoformat(),
+        }
+        async with http.post(url + "/api/layovers", json=layover, headers=user.headers) as res:
+            if res.ok:
+                user.layovers.append(layover)
+            return res.status
+
+    if op == "remove_layover":
+        layover = user.layovers.pop(rng.randrange(len(user.layovers)))
+        async with http.delete(url + "/api/layovers", json=layover, headers=user.headers) as res:
+            return res.status
+
+    if op == "match":
+        iata = user.layovers[-1]["iata"] if user.layovers else rng.choice(STOPS)
+        async with http.get(url + f"/api/layovers/{iata}", headers=user.headers) as res:
+            await res.read()
+            return res.status
+
+    raise ValueError(f"unknown op {op}")
+
+
+async def upstream_calls(http: ClientSession, stub: str) -> dict | None:
+    try:
+        async with http.get(stub + "/_stats") as res:
+            return await res.json()
+    except Exception:
+        return None
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    results = Results()
+    ops, weights = zip(*MIX.items())
+
+    async with ClientSession(timeout=ClientTimeout(total=args.timeout)) as http:
+        print(f"registering and logging in {args.users} users...")
+        users = await setup(http, args.url, args.users, args.password)
+        before = await upstream_calls(http, args.stub)
+
+        async def one(user: User, op: str):
+            start = time.perf_counter()
+            try:
+                status = await do(http, args, rng, user, op)
+            except asyncio.TimeoutError:
+                status = 599
+            except Exception as e:
+                print(f"{op} failed: {e!r}")
+                status = 599
+            results.record(op, status, time.perf_counter() - start)
+
+        print(f"running at {args.rps} requests/s for {args.duration}s...")
+        tasks = []
+        start = time.perf_counter()
+        deadline = start + args.duration
+        while time.perf_counter() < deadline:
+            # Poisson arrivals, so requests bunch up now and then like they do
+            # for real.
+            await asyncio.sleep(rng.expovariate(args.rps))
+            user = rng.choice(users)
+            op = rng.choices(ops, weights)[0]
+            tasks.append(asyncio.ensure_future(one(user, op)))
+
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        after = await upstream_calls(http, args.stub)
+
+    results.report(elapsed)
+    if before is not None and after is not None:
+        calls = {k: after[k] - before[k] for k in after}
+        print(f"upstream calls: {calls}")
+    else:
+        print("upstream calls: unknown, stub not reachable")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a running backend")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--stub", default="http://127.0.0.1:8090", help="stub RapidAPI server")
+    parser.add_argument("--rps", type=float, default=10, help="average requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--dates", type=int, default=14, help="days searches are spread over")
+    parser.add_argument("--timeout", type=float, default=60, help="per request, seconds")
+    parser.add_argument("--password", default="loadtest-password")
+    parser.add_argument("--seed", type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,66 @@
+"""
+Benchmarks flights.calculate_layover_scores, which scores a whole search
+response at once, against scoring it one leg at a time with
+flights.layover_score. The example response is scaled up to thousands of
+itineraries.
+
+Run from the repository root:
+
+    python -m bench.scoring [number of itineraries]
+"""
+
+import sys
+import math
+import time
+
+import flights
+from models import Flight, FlightApiResponse
+
+ITINERARIES = 5000
+
+
+def scalar_layover_scores(search: list[Flight]) -> list[Flight]:
+    for flight in search:
+        assert flight.legs is not None
+
+        total_score = 0
+        for leg in flight.legs:
+            leg.layover_hours = flights.layover_score(leg)
+            total_score += leg.layover_hours
+        flight.layover_hours = total_score / len(flight.legs)
+
+    return search
+
+
+def scaled(search: FlightApiResponse, n: int) -> list[Flight]:
+    assert search.data is not None
+    return [
+        search.data[i % len(search.data)].copy(deep=True, update={"id": str(i)})
+        for i in range(n)
+    ]
+
+
+def bench(label: str, score, search: FlightApiResponse, n: int) -> list[Flight]:
+    best = math.inf
+    for _ in range(5):
+        data = scaled(search, n)
+        t = time.perf_counter()
+        score(data)
+        best = min(best, time.perf_counter() - t)
+
+    print(f"{label:>8}: {best * 1000:8.2f} ms for {n} itineraries")
+    return data
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else ITINERARIES
+
+    with open("data/flight_response_example.json") as f:
+        search = FlightApiResponse.parse_raw(f.read())
+
+    scalar = bench("scalar", scalar_layover_scores, search, n)
+    batch = bench("batch", flights.calculate_layover_scores, search, n)
+
+    for a, b in zip(scalar, batch):
+        assert a.layover_hours is not None and b.layover_hours is not None
+        assert math.isclose(a.layover_hours, b.layover_hours, rel_tol=1e-12)
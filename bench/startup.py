@@ -0,0 +1,37 @@
+"""
+Measures how long a fresh interpreter takes to import a module, by default
+main (the whole app). Each run is a new process so nothing is cached.
+
+Run from the repository root:
+
+    python -m bench.startup [module]
+"""
+
+import sys
+import statistics
+import subprocess
+
+RUNS = 10
+
+
+def time_import(module: str) -> float:
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    modules = sys.argv[1:] or ["airports", "main"]
+
+    for module in modules:
+        times = [time_import(module) for _ in range(RUNS)]
+        print(
+            f"import {module:>10}: "
+            f"min {min(times) * 1000:7.1f} ms, "
+            f"median {statistics.median(times) * 1000:7.1f} ms"
+        )
@@ -0,0 +1,216 @@
+"""
+A stand-in for the RapidAPI Skyscanner endpoints that the backend calls, for
+load testing without spending real quota. Responses are synthetic but shaped
+like data/flight_response_example.json, and the same request always gets the
+same itineraries.
+
+Run from the repository root, then start the backend pointed at it:
+
+    python -m bench.stub_rapidapi --search-latency 1.5 --error-rate 0.02
+    RAPID_API_URL=http://127.0.0.1:8090/api/v1 ./run.sh
+
+GET /_stats returns how many calls each endpoint got; POST /_reset zeroes it.
+"""
+
+import copy
+import json
+import math
+import random
+import asyncio
+import argparse
+import zlib
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+# Layover airports itineraries are routed through; all are real hubs so that
+# the backend can score them.
+STOPS = ["OSL", "CDG", "ZRH", "MUC", "DXB", "SIN", "ICN", "NRT", "LAX", "SFO"]
+
+with open("data/flight_response_example.json") as f:
+    TEMPLATE = json.load(f)["data"][0]
+
+
+def latency(rng: random.Random, median: float, sigma: float) -> float:
+    # Latencies are roughly log-normal: mostly near the median, with a long
+    # tail of slow calls.
+    if median <= 0:
+        return 0
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+def seeded(*parts) -> random.Random:
+    return random.Random(zlib.crc32(json.dumps(parts).encode()))
+
+
+def stop(code: str) -> dict:
+    return {
+        "id": zlib.crc32(code.encode()) % 100000,
+        "entity_id": zlib.crc32(code.encode()),
+        "alt_id": code,
+        "parent_id": None,
+        "parent_entity_id": None,
+        "name": code,
+        "type": "Airport",
+        "display_code": code,
+    }
+
+
+def leg(rng: random.Random, id: str, origin: str, dest: str, day: str) -> dict:
+    departure = datetime.fromisoformat(day) + timedelta(minutes=rng.randrange(5 * 60, 22 * 60, 5))
+    arrival = departure + timedelta(minutes=rng.randrange(6 * 60, 30 * 60, 5))
+    stops = rng.sample(STOPS, rng.choice([1, 1, 2]))
+    return {
+        **copy.deepcopy(TEMPLATE["legs"][0]),
+        "id": id,
+        "origin": stop(origin),
+        "destination": stop(dest),
+        "departure": departure.isoformat(),
+        "arrival": arrival.isoformat(),
+        "duration": int((arrival - departure).total_seconds() / 60),
+        "stop_count": len(stops),
+        "stops": [stop(s) for s in stops],
+    }
+
+
+def search(args, origin: str, dest: str, date: str, return_date: str, wait_time: int) -> dict:
+    rng = seeded(origin, dest, date, return_date)
+
+    flights = []
+    for i in range(args.results):
+        id = f"{origin}{dest}-{date}-{return_date}-{i:04}"
+        amount = round(rng.uniform(80, 2500), 2)
+        price = {**TEMPLATE["price"], "amount": amount, "score": rng.random() * 10}
+        flights.append(
+            {
+                **copy.deepcopy(TEMPLATE),
+                "id": id,
+                "price": price,
+                "amount": amount,
+                "score": price["score"],
+                "legs": [
+                    leg(rng, id + "-0", origin, dest, date),
+                    leg(rng, id + "-1", dest, origin, return_date),
+                ],
+            }
+        )
+
+    # Like the real thing, shorter waits find fewer results, and more of them
+    # on each retry with a longer wait.
+    if args.full_wait > 0:
+        found = max(0.2, min(1.0, wait_time / args.full_wait))
+        flights = flights[: math.ceil(len(flights) * found)]
+
+    return {"status": True, "message": "Success", "timestamp": None, "data": flights}
+
+
+def details(itinerary_id: str, legs: list[dict]) -> dict:
+    rng = seeded(itinerary_id)
+
+    def point(code: str) -> dict:
+        return {"id": str(zlib.crc32(code.encode())), "name": code, "displayCode": code, "city": code}
+
+    detail_legs = []
+    for i, l in enumerate(legs):
+        departure = datetime.fromisoformat(l["date"]) + timedelta(hours=rng.randrange(5, 22))
+        arrival = departure + timedelta(hours=rng.randrange(6, 30))
+        stops = rng.sample(STOPS, rng.choice([1, 1, 2]))
+        path = [l["origin"], *stops, l["destination"]]
+        detail_legs.append(
+            {
+                "id": f"{itinerary_id}-{i}",
+                "origin": point(l["origin"]),
+                "destination": point(l["destination"]),
+                "departure": departure.isoformat(),
+                "arrival": arrival.isoformat(),
+                "segments": [],
+                "layovers": [
+                    {
+                        "segmentId": f"{itinerary_id}-{i}-{j}",
+                        "origin": point(a),
+                        "destination": point(b),
+                        "duration": rng.randrange(60, 12 * 60),
+                    }
+                    for j, (a, b) in enumerate(zip(path, path[1:-1]))
+                ],
+                "duration": int((arrival - departure).total_seconds() / 60),
+                "stopCount": len(stops),
+            }
+        )
+
+    return {
+        "status": True,
+        "message": "Success",
+        "timestamp": 0,
+        "data": {"legs": detail_legs, "pop_score": None},
+    }
+
+
+def app(args) -> web.Application:
+    rng = random.Random()
+    calls = {"searchFlights": 0, "getFlightDetails": 0, "errors": 0}
+
+    async def upstream(endpoint: str, median: float, respond) -> web.Response:
+        calls[endpoint] += 1
+        await asyncio.sleep(latency(rng, median, args.sigma))
+        if rng.random() < args.error_rate:
+            calls["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        return web.json_response(respond())
+
+    async def search_flights(req: web.Request) -> web.Response:
+        q = req.query
+        return await upstream(
+            "searchFlights",
+            args.search_latency,
+            lambda: search(
+                args,
+                q["origin"],
+                q["destination"],
+                q["date"],
+                q["returnDate"],
+                int(q.get("waitTime", 0)),
+            ),
+        )
+
+    async def get_flight_details(req: web.Request) -> web.Response:
+        q = req.query
+        return await upstream(
+            "getFlightDetails",
+            args.detail_latency,
+            lambda: details(q["itineraryId"], json.loads(q["legs"])),
+        )
+
+    async def stats(req: web.Request) -> web.Response:
+        return web.json_response(calls)
+
+    async def reset(req: web.Request) -> web.Response:
+        for k in calls:
+            calls[k] = 0
+        return web.json_response(calls)
+
+    app = web.Application()
+    app.router.add_get("/api/v1/searchFlights", search_flights)
+    app.router.add_get("/api/v1/getFlightDetails", get_flight_details)
+    app.router.add_get("/_stats", stats)
+    app.router.add_post("/_reset", reset)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in RapidAPI server")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--results", type=int, default=200, help="itineraries per search")
+    parser.add_argument("--search-latency", type=float, default=1.0, help="median, seconds")
+    parser.add_argument("--detail-latency", type=float, default=0.4, help="median, seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="spread of latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503s")
+    parser.add_argument(
+        "--full-wait",
+        type=int,
+        default=0,
+        help="waitTime in ms that finds every result; less finds fewer (0: off)",
+    )
+    args = parser.parse_args()
+
+    web.run_app(app(args), host="127.0.0.1", port=args.port)
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import calendar
+import tempfile
+from datetime import datetime, timezone
+
+from models import BudgetState
+
+# RapidAPI's monthly allowance. rapid_api_limiter in flights.py still enforces
+# this as a hard limit; this module tries to make it last the whole month.
+MONTHLY_BUDGET = int(os.environ.get("RAPID_API_MONTHLY_BUDGET", 5000))
+
+# Once only this fraction of the budget is left, stop calling upstream for
+# anything that isn't already cached.
+CACHE_ONLY_RESERVE = 0.02
+
+WORKING_DIR = os.path.join(tempfile.gettempdir(), "layover-party")
+BUDGET_DB = os.path.join(WORKING_DIR, "budget.db")
+
+os.makedirs(WORKING_DIR, exist_ok=True)
+
+db = sqlite3.connect(BUDGET_DB, check_same_thread=False)
+db.executescript(
+    """
+    PRAGMA journal_mode=WAL;
+
+    CREATE TABLE IF NOT EXISTS spend (
+        month TEXT NOT NULL,
+        endpoint TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (month, endpoint, user_id)
+    );
+    """
+)
+db.commit()
+
+
+def __month(now: datetime) -> str:
+    return now.strftime("%Y-%m")
+
+
+def record(endpoint: str, user_id: str, now: datetime | None = None):
+    """
+    Records that one upstream call was made to the given endpoint on behalf of
+    the given user.
+    """
+    now = now or datetime.now(timezone.utc)
+    db.execute(
+        """
+        INSERT INTO spend (month, endpoint, user_id, count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (month, endpoint, user_id) DO UPDATE SET count = count + 1
+        """,
+        (__month(now), endpoint, user_id),
+    )
+    db.commit()
+
+
+def state(now: datetime | None = None) -> BudgetState:
+    """
+    Returns how much of this month's budget has been spent and how upstream
+    calls should be rationed for the rest of the month.
+    """
+    now = now or datetime.now(timezone.utc)
+    month = __month(now)
+
+    by_endpoint = dict(
+        db.execute(
+            "SELECT endpoint, SUM(count) FROM spend WHERE month = ? GROUP BY endpoint",
+            (month,),
+        ).fetchall()
+    )
+    top_users = dict(
+        db.execute(
+            """
+            SELECT user_id, SUM(count) AS total FROM spend WHERE month = ?
+            GROUP BY user_id ORDER BY total DESC LIMIT 10
+            """,
+            (month,),
+        ).fetchall()
+    )
+
+    spent = sum(by_endpoint.values())
+    remaining = max(0, MONTHLY_BUDGET - spent)
+
+    days_in_month = calendar.monthrange(now.year, now.month)[1]
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    days_elapsed = (now - month_start).total_seconds() / 86400
+    days_left = days_in_month - days_elapsed
+
+    # What we would have spent by now at an even pace, plus a day of slack so
+    # that a busy first hour of the month doesn't look like a runaway rate.
+    allowed_so_far = MONTHLY_BUDGET * (days_elapsed + 1) / days_in_month
+    pace = spent / allowed_so_far
+
+    if remaining <= MONTHLY_BUDGET * CACHE_ONLY_RESERVE:
+        mode = "cache_only"
+        fanout = 0.0
+    elif pace > 1:
+        # Spending too fast: fetch proportionally fewer flight details so
+        # that searches, which are needed to serve anything, keep working.
+        mode = "conserve"
+        fanout = 1 / pace
+    else:
+        mode = "normal"
+        fanout = 1.0
+
+    return BudgetState(
+        month=month,
+        budget=MONTHLY_BUDGET,
+        spent=spent,
+        remaining=remaining,
+        days_left=days_left,
+        projected=round(spent / max(days_elapsed, 1) * days_in_month),
+        daily_allowance=remaining / days_left,
+        pace=pace,
+        mode=mode,
+        detail_fanout=fanout,
+        by_endpoint=by_endpoint,
+        top_users=top_users,
+    )
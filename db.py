@@ -3,6 +3,50 @@ import os
 
 DB_PATH = os.environ.get("DB_PATH", "./sqlite.v2.db")
 
+# Changes to existing rows that schema.sql can't make idempotently. Each runs
+# once, in order, tracked by PRAGMA user_version.
+MIGRATIONS = [
+    # Layovers used to be stored with whatever UTC offset they were sent with,
+    # and could be any length. Store them in UTC, as layovers.in_utc does, and
+    # cut them to layovers.MAX_LAYOVER (7 days), dropping any that then
+    # duplicate another of the same user's layovers. Sub-second precision
+    # of the old rows is lost.
+    """
+    CREATE TEMP VIEW layovers_utc AS
+        SELECT
+            rowid,
+            user_id,
+            iata_code,
+            strftime('%Y-%m-%d %H:%M:%S', arrive) || '+00:00' AS arrive,
+            CASE
+                WHEN julianday(depart) > julianday(arrive, '+7 days')
+                THEN strftime('%Y-%m-%d %H:%M:%S', arrive, '+7 days')
+                ELSE strftime('%Y-%m-%d %H:%M:%S', depart)
+            END || '+00:00' AS depart,
+            arrive NOT LIKE '%+00:00'
+                OR depart NOT LIKE '%+00:00'
+                OR julianday(depart) > julianday(arrive, '+7 days') AS changed
+        FROM layovers;
+
+    DELETE FROM layovers WHERE rowid IN (
+        SELECT a.rowid FROM layovers_utc a JOIN layovers_utc b
+            ON b.user_id = a.user_id
+            AND b.iata_code = a.iata_code
+            AND b.arrive = a.arrive
+            AND b.depart = a.depart
+            AND b.rowid != a.rowid
+        WHERE a.changed AND (NOT b.changed OR b.rowid < a.rowid)
+    );
+
+    UPDATE layovers SET
+        arrive = (SELECT arrive FROM layovers_utc WHERE rowid = layovers.rowid),
+        depart = (SELECT depart FROM layovers_utc WHERE rowid = layovers.rowid)
+    WHERE rowid IN (SELECT rowid FROM layovers_utc WHERE changed);
+
+    DROP VIEW layovers_utc;
+    """,
+]
+
 
 db = sqlite3.connect(DB_PATH, check_same_thread=False)
 db.row_factory = sqlite3.Row
@@ -10,3 +54,7 @@ db.row_factory = sqlite3.Row
 with open("schema.sql") as f:
     db.executescript(f.read())
     db.commit()
+
+version = db.execute("PRAGMA user_version").fetchone()[0]
+for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+    db.executescript(f"BEGIN; {migration} PRAGMA user_version = {i}; COMMIT;")
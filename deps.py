@@ -1,3 +1,4 @@
+import os
 import time
 from typing import Annotated
 
@@ -8,16 +9,35 @@ from models import AuthorizedUser
 from db import db
 
 
-def get_authorized_user(
-    credentials: Annotated[HTTPAuthorizationCredentials, Depends(HTTPBearer())]
-) -> AuthorizedUser:
+def get_user_by_token(token: str) -> AuthorizedUser | None:
     cur = db.cursor()
     res = cur.execute(
         "SELECT user_id FROM sessions WHERE token = ? AND expiration > ?",
-        (credentials.credentials, int(time.time())),
+        (token, int(time.time())),
     )
     row = res.fetchone()
     if row is None:
-        raise HTTPException(status_code=401)
+        return None
 
     return AuthorizedUser(row[0])
+
+
+def get_authorized_user(
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(HTTPBearer())]
+) -> AuthorizedUser:
+    user = get_user_by_token(credentials.credentials)
+    if user is None:
+        raise HTTPException(status_code=401)
+
+    return user
+
+
+def get_admin_user(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)]
+) -> AuthorizedUser:
+    # Admins are configured as a comma-separated list of user IDs.
+    admins = os.environ.get("ADMIN_USER_IDS", "").split(",")
+    if user.id not in admins:
+        raise HTTPException(status_code=403)
+
+    return user
@@ -0,0 +1,121 @@
+import math
+from functools import lru_cache
+from typing import Iterable
+
+import airports
+from kdtree import EARTH_RADIUS
+
+# The busiest hubs by passenger traffic. Distances between every pair of these
+# are computed up front since most itineraries connect through them.
+HUBS = [
+    "ATL", "DXB", "DFW", "LHR", "HND", "DEN", "IST", "LAX", "ORD", "CDG",
+    "DEL", "AMS", "FRA", "MAD", "JFK", "SIN", "ICN", "CAN", "BCN", "LAS",
+    "SFO", "MEX", "SEA", "MCO", "EWR", "CLT", "PHX", "MUC", "IAH", "MIA",
+    "BKK", "NRT", "PVG", "PEK", "HKG", "YYZ", "SYD", "DOH", "KUL", "FCO",
+    "LGW", "BOS", "MSP", "DTW", "CGK", "MNL", "TPE", "ZRH", "VIE", "CPH",
+]  # fmt: skip
+
+# Size of the memoized cache for pairs that aren't between two hubs.
+CACHE_SIZE = 65536
+
+
+def _haversine(a: str, b: str) -> float | None:
+    a1 = airports.get_by_iata(a)
+    a2 = airports.get_by_iata(b)
+    if a1 is None or a2 is None:
+        return None
+
+    # Same formula as flights.calculate_distance, written with asin.
+    lat1 = math.radians(a1.lat)
+    lat2 = math.radians(a2.lat)
+    sin_dlat = math.sin((lat2 - lat1) / 2)
+    sin_dlon = math.sin(math.radians(a2.long - a1.long) / 2)
+    h = sin_dlat * sin_dlat + math.cos(lat1) * math.cos(lat2) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, h)))
+
+
+def __compute_hubs() -> dict[tuple[str, str], float]:
+    hubs = sorted(h for h in HUBS if airports.get_by_iata(h) is not None)
+    distances = {}
+    for i, a in enumerate(hubs):
+        for b in hubs[i + 1 :]:
+            d = _haversine(a, b)
+            assert d is not None
+            distances[(a, b)] = d
+    return distances
+
+
+hub_distances = __compute_hubs()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached(a: str, b: str) -> float | None:
+    return _haversine(a, b)
+
+
+def get_distance(a: str, b: str) -> float | None:
+    """
+    Returns the great-circle distance in km between two airports given their
+    IATA codes, or None if either airport is unknown.
+    """
+    if a == b:
+        return 0.0 if airports.get_by_iata(a) is not None else None
+
+    # Distances are symmetric, so both tiers store each pair once.
+    if a > b:
+        a, b = b, a
+
+    if (d := hub_distances.get((a, b))) is not None:
+        return d
+
+    return _cached(a, b)
+
+
+def get_distances(pairs: Iterable[tuple[str, str]]) -> list[float | None]:
+    """
+    Looks up the distances of many airport pairs at once, in order. Pairs that
+    appear more than once are only resolved once.
+    """
+    resolved: dict[tuple[str, str], float | None] = {}
+    result = []
+    for pair in pairs:
+        if pair not in resolved:
+            resolved[pair] = get_distance(*pair)
+        result.append(resolved[pair])
+    return result
+
+
+def reload():
+    """
+    Recomputes all distances. Call this after airports.reload().
+    """
+    global hub_distances
+    hub_distances = __compute_hubs()
+    _cached.cache_clear()
+
+
+def cache_info():
+    return _cached.cache_info()
+
+
+if __name__ == "__main__":
+    import random
+    from flights import calculate_distance
+
+    codes = [a.iata for a in airports.registry.airports]
+    pairs = [(random.choice(codes), random.choice(codes)) for _ in range(10000)]
+    pairs += [(a, b) for a in HUBS for b in HUBS]
+
+    for (a, b), d in zip(pairs, get_distances(pairs)):
+        a1 = airports.get_by_iata(a)
+        a2 = airports.get_by_iata(b)
+        if a1 is None or a2 is None:
+            assert d is None
+            continue
+
+        assert d is not None
+        expected = calculate_distance((a1.lat, a1.long), (a2.lat, a2.long))
+        assert math.isclose(d, expected, rel_tol=1e-9, abs_tol=1e-6), (a, b)
+
+    print(f"{len(hub_distances)} hub pairs, {cache_info()}")
+    print("Bueno ✊🍆💦")
@@ -0,0 +1,184 @@
+import math
+import asyncio
+from datetime import date as Date, timedelta
+
+import budget
+import httputil
+import searches
+from airports import find_by_coords, get_by_iata
+from flights import flight_searches
+from models import FlexibleFlight, FlexibleQuery
+
+# Nearby airports considered on each side, on top of the one asked for.
+MAX_NEARBY = 3
+
+# Most searches a plan can list, closest to what was asked for first.
+MAX_QUERIES = 100
+
+# Upstream searches made at the same time. Each one also goes through the
+# usual rate limiters.
+CONCURRENCY = 3
+
+
+def nearby(iata: str, radius: float | None) -> list[tuple[str, float]]:
+    """
+    Returns the airport and the ones within radius km of it, closest first,
+    as (IATA code, distance in km) pairs.
+    """
+    airport = get_by_iata(iata)
+    if airport is None or radius is None:
+        return [(iata, 0.0)]
+
+    found = find_by_coords(airport.lat, airport.long, MAX_NEARBY + 1, radius)
+    codes = [(a.iata, km) for a, km in found if a.iata != iata]
+    return [(iata, 0.0), *codes[:MAX_NEARBY]]
+
+
+def plan(
+    origin: str,
+    dest: str,
+    date: Date,
+    return_date: Date,
+    date_window: int = 0,
+    radius: float | None = None,
+    max_upstream: int = 0,
+    today: Date | None = None,
+) -> list[FlexibleQuery]:
+    """
+    Plans the searches that cover every pair of airports within radius km of
+    origin and dest and every pair of dates within date_window days of date
+    and return_date. Searches already cached are free; up to max_upstream of
+    the rest are searched upstream, closest dates and airports first, and the
+    others are skipped.
+    """
+    today = today or Date.today()
+
+    candidates = []
+    for o, o_km in nearby(origin, radius):
+        for d, d_km in nearby(dest, radius):
+            if o == d:
+                continue
+            for dd in range(-date_window, date_window + 1):
+                for dr in range(-date_window, date_window + 1):
+                    depart = date + timedelta(days=dd)
+                    back = return_date + timedelta(days=dr)
+                    if depart < today or depart > back:
+                        continue
+                    cost = (abs(dd) + abs(dr), o_km + d_km)
+                    candidates.append((cost, o, d, depart, back))
+
+    candidates.sort(key=lambda c: c[0])
+
+    queries = []
+    upstream = 0
+    for _, o, d, depart, back in candidates[:MAX_QUERIES]:
+        if httputil.contains(searches.key(o, d, depart, back)):
+            source = "cache"
+        elif upstream < max_upstream:
+            source = "upstream"
+            upstream += 1
+        else:
+            source = "skipped"
+
+        queries.append(
+            FlexibleQuery(
+                origin=o,
+                dest=d,
+                date=depart,
+                return_date=back,
+                source=source,
+            )
+        )
+
+    return queries
+
+
+def upstream_allowance(max_upstream: int) -> int:
+    """
+    Returns how many upstream searches one fan-out may make given the monthly
+    budget.
+    """
+    spend = budget.state()
+    return min(math.floor(max_upstream * spend.detail_fanout), spend.remaining)
+
+
+async def run(
+    queries: list[FlexibleQuery],
+    num_adults: int,
+    wait_time: int,
+    user_id: str,
+) -> int:
+    """
+    Makes the upstream searches of a plan. Queries that fail are marked as
+    failed and the rest still go through. Returns how many upstream searches
+    were made for this plan, leaving out the ones that joined someone else's.
+    """
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    made = 0
+
+    async def search(q: FlexibleQuery):
+        key = searches.key(q.origin, q.dest, q.date, q.return_date)
+        ran = False
+
+        async def fetch():
+            nonlocal ran, made
+            ran = True
+            made += 1
+            return await searches.fetch(
+                q.origin,
+                q.dest,
+                q.date,
+                q.return_date,
+                num_adults,
+                wait_time,
+                user_id,
+            )
+
+        async with semaphore:
+            try:
+                await flight_searches.do(key, fetch)
+            except Exception as e:
+                q.source = "failed"
+                q.error = getattr(e, "detail", None) or repr(e)
+                return
+
+        if not ran:
+            # Someone else already paid for this one.
+            q.source = "coalesced"
+
+    await asyncio.gather(*(search(q) for q in queries if q.source == "upstream"))
+    return made
+
+
+def merge(queries: list[FlexibleQuery], limit: int) -> list[FlexibleFlight]:
+    """
+    Ranks the itineraries of every search in the plan that has results
+    together by layover hours, best first.
+    """
+    flights: dict[str, FlexibleFlight] = {}
+    for q in queries:
+        if q.source in ("skipped", "failed"):
+            continue
+
+        rows = searches.top(searches.key(q.origin, q.dest, q.date, q.return_date), limit)
+        q.count = len(rows)
+        for id, hours, price in rows:
+            flights.setdefault(
+                id,
+                FlexibleFlight(
+                    itinerary_id=id,
+                    origin=q.origin,
+                    dest=q.dest,
+                    date=q.date,
+                    return_date=q.return_date,
+                    layover_hours=hours,
+                    price=price,
+                ),
+            )
+
+    ranked = sorted(
+        flights.values(),
+        key=lambda f: f.layover_hours if f.layover_hours is not None else -math.inf,
+        reverse=True,
+    )
+    return ranked[:limit]
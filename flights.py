@@ -1,16 +1,20 @@
 import os
 import math
 import json
-import tempfile
-from typing import cast
+from typing import NamedTuple, cast
 from datetime import date as Date
 
+import numpy as np
 from fastapi import HTTPException
-from pyrate_limiter import RequestRate, Limiter, Duration, SQLiteBucket
+from pyrate_limiter import RequestRate, Duration
 
+import budget
 import limiter
 import httputil
 import airports
+import distances
+import singleflight
+import upstream
 from models import *
 
 from dotenv import load_dotenv
@@ -19,7 +23,8 @@ load_dotenv()
 
 
 RAPID_API_HOST = "skyscanner50.p.rapidapi.com"
-RAPID_API_URL = "https://" + RAPID_API_HOST + "/api/v1"
+# Point this at bench/stub_rapidapi.py to run without spending real quota.
+RAPID_API_URL = os.getenv("RAPID_API_URL", "https://" + RAPID_API_HOST + "/api/v1")
 RAPID_API_HEADERS = {
     "X-RapidAPI-Key": os.getenv("RAPID_API_KEY"),
     "X-RapidAPI-Host": RAPID_API_HOST,
@@ -53,6 +58,23 @@ def calculate_distance(p1: tuple[float, float], p2: tuple[float, float]) -> floa
     return d
 
 
+def calculate_distances(
+    lat1: np.ndarray,
+    lon1: np.ndarray,
+    lat2: np.ndarray,
+    lon2: np.ndarray,
+) -> np.ndarray:
+    """
+    Vectorized calculate_distance over arrays of coordinates in radians.
+    """
+    R = 6371  # Radius of the earth in km
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    a = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
 def plane_speed(distance: float) -> float:
     # obtained from linearly interpolating the data from two points:
     # (722,  395) -- SGN to HAN
@@ -60,40 +82,45 @@ def plane_speed(distance: float) -> float:
     return 0.033029853906415 * distance + 371.15244547957
 
 
-def layover_score(leg: Leg) -> float:
+def stop_pairs(leg: Leg) -> list[tuple[str, str]]:
     """
-    Estimates a score that indicates how much layover we could get from the
-    given leg.
+    Returns the IATA codes of every consecutive pair of stops in the given leg,
+    skipping stops without a code.
     """
-
-    flight_distance = 0
     stops = [
         leg.origin,
         *(leg.stops if leg.stops is not None else []),
         leg.destination,
     ]
 
+    pairs = []
     for i in range(len(stops) - 1):
         stop1 = stops[i]
         stop2 = stops[i + 1]
 
-        try:
-            assert stop1 is not None
-            assert stop2 is not None
-            assert stop1.display_code is not None
-            assert stop2.display_code is not None
-        except:
+        if (
+            stop1 is None
+            or stop2 is None
+            or stop1.display_code is None
+            or stop2.display_code is None
+        ):
             continue
 
-        stop1_airport = airports.get_by_iata(stop1.display_code)
-        stop2_airport = airports.get_by_iata(stop2.display_code)
-        assert stop1_airport is not None
-        assert stop2_airport is not None
+        pairs.append((stop1.display_code, stop2.display_code))
+
+    return pairs
 
-        flight_distance += calculate_distance(
-            (stop1_airport.lat, stop1_airport.long),
-            (stop2_airport.lat, stop2_airport.long),
-        )
+
+def layover_score(leg: Leg) -> float:
+    """
+    Estimates a score that indicates how much layover we could get from the
+    given leg. Stops at airports we don't know about are skipped.
+    """
+
+    flight_distance = 0
+    for distance in distances.get_distances(stop_pairs(leg)):
+        if distance is not None:
+            flight_distance += distance
 
     # Estimate just the time it takes to fly in-between airports.
     flight_time = flight_distance / plane_speed(flight_distance)  # hours
@@ -127,21 +154,82 @@ def remove_invalid_flights(flights: list[Flight]) -> list[Flight]:
 def calculate_layover_scores(flights: list[Flight]) -> list[Flight]:
     """
     Calculates the layover scores for each flight in the given parsed response.
+
+    This gives the same numbers as calling layover_score on every leg, but
+    flattens every leg of every flight into arrays first so that the math,
+    distances included, is done for the whole response at once over the
+    registry's coordinate arrays. The distance service is only for scoring a
+    leg at a time.
     """
-    for flight in flights:
+    registry = airports.registry
+
+    leg_flight: list[int] = []  # index of the flight each leg belongs to
+    durations: list[float] = []  # total duration of each leg in seconds
+    pair_leg: list[int] = []  # index of the leg each stop pair belongs to
+    pair_codes: list[str] = []  # IATA codes of both airports of each pair
+
+    for i, flight in enumerate(flights):
+        assert flight.legs is not None
+
+        for leg in flight.legs:
+            n = len(leg_flight)
+            # Same pairs as stop_pairs(leg), inlined since this is the hot loop.
+            codes = [
+                stop.display_code if stop is not None else None
+                for stop in (leg.origin, *(leg.stops or ()), leg.destination)
+            ]
+            for a, b in zip(codes, codes[1:]):
+                if a is not None and b is not None:
+                    pair_leg.append(n)
+                    pair_codes.append(a)
+                    pair_codes.append(b)
+
+            leg_flight.append(i)
+            durations.append((leg.arrival - leg.departure).total_seconds())
+
+    n_legs = len(leg_flight)
+    if n_legs == 0:
+        return flights
+
+    # Distance of every stop pair, summed into the distance of every leg.
+    # Pairs with an airport we don't know about are skipped, like layover_score.
+    positions = registry.positions(pair_codes).reshape(-1, 2)
+    known = (positions >= 0).all(axis=1)
+    coords = registry.radians[positions[known]].reshape(-1, 4)
+    pair_distances = np.zeros(len(positions))
+    pair_distances[known] = calculate_distances(*coords.T)
+    leg_distances = np.bincount(pair_leg, weights=pair_distances, minlength=n_legs)
+
+    # Same as layover_score, for every leg.
+    flight_time = leg_distances / plane_speed(leg_distances)  # type: ignore
+    leg_scores = np.array(durations) / 3600 - flight_time
+
+    leg_counts = np.bincount(leg_flight, minlength=len(flights))
+    flight_scores = np.bincount(leg_flight, weights=leg_scores, minlength=len(flights))
+    flight_scores /= np.maximum(leg_counts, 1)
+
+    leg_score = iter(leg_scores.tolist())
+    for flight, score in zip(flights, flight_scores.tolist()):
         assert flight.legs is not None
 
-        total_score = 0
         for leg in flight.legs:
-            leg.layover_hours = layover_score(leg)
-            total_score += leg.layover_hours
-        flight.layover_hours = total_score / len(flight.legs)
+            _set_layover_hours(leg, next(leg_score))
+        _set_layover_hours(flight, score)
 
     return flights
 
 
-# 5000/1mo
+def _set_layover_hours(model: Leg | Flight, hours: float):
+    # Going through pydantic's __setattr__ is over half the cost of scoring a
+    # response, and there is nothing for it to validate in a float we computed.
+    model.__dict__["layover_hours"] = hours
+    model.__fields_set__.add("layover_hours")
+
+
+# 5000/1mo, counted per request actually sent upstream (see _spend), so
+# retries and hedges count too.
 rapid_api_limiter = limiter.new(RequestRate(5000, Duration.MONTH))
+RAPID_API_IDENTITY = "rapidapi"
 
 fetch_flights_limiter = limiter.new(RequestRate(10, Duration.SECOND))
 fetch_flights_user_limiter = limiter.new(RequestRate(5, 30 * Duration.SECOND))
@@ -149,8 +237,68 @@ fetch_flights_user_limiter = limiter.new(RequestRate(5, 30 * Duration.SECOND))
 fetch_details_limiter = limiter.new(RequestRate(4, Duration.SECOND))
 fetch_details_user_limiter = limiter.new(RequestRate(10, 30 * Duration.SECOND))
 
+# Searches are fresh for an hour; after that they're still served, but get
+# refreshed in the background. Flight details change less often and are
+# never refreshed.
+SEARCH_CACHE = httputil.Namespace(soft_ttl=60 * 60)
+DETAILS_CACHE = httputil.Namespace(soft_ttl=httputil.MAX_AGE)
+
+
+POP_SCORE = '"pop_score": '
+
+
+class DetailFragment(NamedTuple):
+    """
+    A flight detail response serialized ahead of time and split around its
+    pop_score, so pages can be put together from bytes without parsing or
+    validating anything again.
+    """
+
+    head: bytes
+    tail: bytes | None  # None if there's no pop_score to fill in
+    layovers: tuple[str, ...]  # IATA codes, one per layover
+
+    def render(self, pop_score: int | None) -> bytes:
+        if self.tail is None:
+            return self.head
+        return self.head + json.dumps(pop_score).encode() + self.tail
+
+    @classmethod
+    def parse(cls, raw: str) -> "DetailFragment":
+        data = json.loads(raw).get("data")
+
+        layovers = []
+        for leg in (data or {}).get("legs") or []:
+            for layover in leg.get("layovers") or []:
+                layovers.append(layover["destination"]["displayCode"])
+
+        # pop_score is the last field of the last object, so the value ends
+        # at the next brace.
+        i = raw.rfind(POP_SCORE) if data is not None else -1
+        if i == -1:
+            return cls(raw.encode(), None, tuple(layovers))
+
+        i += len(POP_SCORE)
+        j = raw.index("}", i)
+        return cls(raw[:i].encode(), raw[j:].encode(), tuple(layovers))
+
+    @classmethod
+    def of(cls, detail: FlightDetailResponse) -> "DetailFragment":
+        return cls.parse(detail.json())
+
+
+def _spend(endpoint: str, user_id: str):
+    # Raises limiter.LimitedException once the monthly quota is used up.
+    rapid_api_limiter.try_acquire(RAPID_API_IDENTITY)
+    budget.record(endpoint, user_id)
+
+
+# Identical searches and detail fetches made at the same time share one
+# upstream call, keyed on their cache keys.
+flight_searches: singleflight.Group[FlightApiResponse] = singleflight.Group()
+flight_details: singleflight.Group[DetailFragment] = singleflight.Group()
+
 
-@rapid_api_limiter.ratelimit()
 async def fetch_flight_details(
     itineraryId: str,
     origin: str,
@@ -161,12 +309,12 @@ async def fetch_flight_details(
     user_id: str,  # used for user-specific rate limiting
 ) -> FlightDetailResponse:
     await limiter.wait(
-        lambda: rapid_api_limiter.ratelimit(),
         lambda: fetch_details_limiter.ratelimit(delay=True),
         lambda: fetch_details_user_limiter.ratelimit(user_id, delay=True),
     )
 
-    res = await httputil.client.get(
+    res = await upstream.get(
+        "getFlightDetails",
         RAPID_API_URL + "/getFlightDetails",
         headers=RAPID_API_HEADERS,
         params={
@@ -182,12 +330,12 @@ async def fetch_flight_details(
             "countryCode": "US",
             "market": "en-US",
         },
+        cost=lambda: _spend("getFlightDetails", user_id),
+        hedge=True,
     )
 
-    text = await res.text()
-
     try:
-        data = FlightDetailResponse.parse_raw(text)
+        data = FlightDetailResponse.parse_raw(res.text)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -201,7 +349,6 @@ async def fetch_flight_details(
     return data
 
 
-@rapid_api_limiter.ratelimit()
 async def fetch_flights(
     origin: str,
     dest: str,
@@ -212,13 +359,12 @@ async def fetch_flights(
     user_id: str,  # used for user-specific rate limiting
 ) -> FlightApiResponse:
     await limiter.wait(
-        lambda: rapid_api_limiter.ratelimit(),
         lambda: fetch_flights_limiter.ratelimit(delay=True),
         lambda: fetch_flights_user_limiter.ratelimit(user_id, delay=True),
     )
 
-    print(RAPID_API_HEADERS)
-    res = await httputil.client.get(
+    res = await upstream.get(
+        "searchFlights",
         RAPID_API_URL + "/searchFlights",
         headers=RAPID_API_HEADERS,
         params={
@@ -232,10 +378,11 @@ async def fetch_flights(
             "countryCode": "US",
             "market": "en-US",
         },
+        cost=lambda: _spend("searchFlights", user_id),
     )
 
     try:
-        data = FlightApiResponse.parse_raw(await res.text())
+        data = FlightApiResponse.parse_raw(res.text)
     except Exception as e:
         raise HTTPException(
             status_code=500,
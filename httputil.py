@@ -1,72 +1,439 @@
 import os
+import re
+import sys
+import glob
 import time
 import json
+import zlib
+import asyncio
+import hashlib
 import sqlite3
 import tempfile
 import traceback
-from typing import Any, Callable
+from collections import OrderedDict
+from functools import cache
+from typing import Any, Callable, NamedTuple
 
-from aiohttp import ClientSession
 from fastapi import HTTPException
 
+from models import CacheStats
+from singleflight import normalize_key
+
 
 MAX_AGE = 60 * 60 * 24 * 14  # 14 days or 2 weeks
 
 WORKING_DIR = os.path.join(tempfile.gettempdir(), "layover-party")
 HTTPCACHE_DB = os.path.join(WORKING_DIR, "httpcache.db")
 
+# Size caps for parsed responses kept in memory and for the cache database.
+MEMORY_CACHE_BYTES = int(os.environ.get("HTTPCACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+DISK_CACHE_BYTES = int(os.environ.get("HTTPCACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+# How often expired and least recently used rows are swept from the database.
+SWEEP_INTERVAL = 5 * 60
+
+# Cached responses are stored zlib-compressed with a preset dictionary trained
+# on RapidAPI flight details; `python httputil.py train` makes a new one. Each
+# dictionary is data/httpcache.v<N>.zdict and rows record the N they were
+# written with, so older rows stay readable after retraining. Version 0 rows
+# are from before this format: a JSON text key and an uncompressed response.
+ZDICT_PATH = "data/httpcache.v{}.zdict"
+FORMAT_VERSION = max(
+    (
+        int(m.group(1))
+        for path in glob.glob(ZDICT_PATH.format("*"))
+        if (m := re.search(r"\.v(\d+)\.zdict$", path)) is not None
+    ),
+    default=0,
+)
+ZLIB_LEVEL = 6
+
+
+os.makedirs(WORKING_DIR, exist_ok=True)
 
 db = sqlite3.connect(HTTPCACHE_DB, check_same_thread=False)
 db.row_factory = sqlite3.Row
 db.executescript(
     """
     PRAGMA journal_mode=WAL;
+    PRAGMA foreign_keys=ON;
     PRAGMA strict=ON;
 
     CREATE TABLE IF NOT EXISTS cache (
         key TEXT PRIMARY KEY,
         expiry INTEGER NOT NULL,
-    	response TEXT NOT NULL
+    	response TEXT NOT NULL,
+        stored INTEGER NOT NULL DEFAULT 0,
+        accessed INTEGER NOT NULL DEFAULT 0,
+        size INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0
     );
     """
 )
+__columns = [row["name"] for row in db.execute("PRAGMA table_info(cache)")]
+if "stored" not in __columns:
+    # Rows from before this column existed count as infinitely old.
+    db.execute("ALTER TABLE cache ADD COLUMN stored INTEGER NOT NULL DEFAULT 0")
+if "accessed" not in __columns:
+    db.execute("ALTER TABLE cache ADD COLUMN accessed INTEGER NOT NULL DEFAULT 0")
+if "size" not in __columns:
+    db.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+    db.execute("UPDATE cache SET size = length(response)")
+if "version" not in __columns:
+    db.execute("ALTER TABLE cache ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+db.executescript(
+    """
+    CREATE INDEX IF NOT EXISTS cache_expiry ON cache (expiry);
+    CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+    """
+)
 db.commit()
 
-client = ClientSession()
 
+class Namespace(NamedTuple):
+    """
+    Cache lifetimes for one kind of response. Entries older than soft_ttl are
+    stale: still served, but callers should refresh them. Entries older than
+    hard_ttl are gone.
+    """
+
+    soft_ttl: int
+    hard_ttl: int = MAX_AGE
 
-def get_cached(key: dict) -> str | None:
-    keystr = json.dumps(key)
 
+DEFAULT = Namespace(soft_ttl=MAX_AGE, hard_ttl=MAX_AGE)
+
+
+@cache
+def __zdict(version: int) -> bytes:
+    with open(ZDICT_PATH.format(version), "rb") as f:
+        return f.read()
+
+
+def encode(response: str) -> bytes | str:
+    """
+    Compresses a response in the current FORMAT_VERSION.
+    """
+    if FORMAT_VERSION == 0:
+        return response
+
+    c = zlib.compressobj(ZLIB_LEVEL, zdict=__zdict(FORMAT_VERSION))
+    return c.compress(response.encode()) + c.flush()
+
+
+def decode(version: int, data: bytes | str) -> str:
+    if version == 0:
+        assert isinstance(data, str)
+        return data
+
+    assert isinstance(data, bytes)
+    d = zlib.decompressobj(zdict=__zdict(version))
+    return (d.decompress(data) + d.flush()).decode()
+
+
+def digest(key: dict) -> bytes:
+    """
+    Returns the fixed-size database key of a cache key. Equal keys have the
+    same digest regardless of the order of their fields.
+    """
+    return hashlib.sha256(normalize_key(key).encode()).digest()
+
+
+class CacheEntry:
+    __slots__ = ("version", "data", "age", "stale", "value")
+
+    version: int
+    data: bytes | str  # the response as stored, see decode
+    age: float  # seconds
+    stale: bool
+    value: Any  # the parsed response, if asked for
+
+    def __init__(self, version: int, data: bytes | str, age: float, stale: bool, value: Any):
+        self.version = version
+        self.data = data
+        self.age = age
+        self.stale = stale
+        self.value = value
+
+    @property
+    def response(self) -> str:
+        return decode(self.version, self.data)
+
+
+class __MemoryEntry:
+    __slots__ = ("version", "data", "size", "value", "stored", "expiry", "accessed")
+
+    def __init__(
+        self,
+        version: int,
+        data: bytes | str,
+        size: int,
+        value: Any,
+        stored: float,
+        expiry: float,
+    ):
+        self.version = version
+        self.data = data
+        # Uncompressed size, as an estimate of how much memory the parsed value
+        # takes up.
+        self.size = size
+        self.value = value
+        self.stored = stored
+        self.expiry = expiry
+        self.accessed = stored
+
+
+class LRU:
+    """
+    The in-memory tier of the cache: the most recently used responses along
+    with their parsed values, up to a total uncompressed size of max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.entries: OrderedDict[bytes, Any] = OrderedDict()
+
+    def get(self, key: bytes):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: bytes, entry):
+        self.pop(key)
+        if entry.size > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.bytes += entry.size
+
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def pop(self, key: bytes):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+
+memory = LRU(MEMORY_CACHE_BYTES)
+
+hits = {"memory": 0, "disk": 0}
+misses = 0
+disk_evictions = 0
+expired = 0
+
+
+def __select(key: dict, keyhash: bytes, now: float) -> sqlite3.Row | None:
+    res = db.execute(
+        """
+        SELECT version, response, stored, expiry, size FROM cache
+        WHERE key = ? AND expiry > ?
+        """,
+        (keyhash, now),
+    )
+    if (row := res.fetchone()) is not None:
+        return row
+
+    # Rows from before keys were hashed are keyed on their JSON text. Move
+    # them over to the current format as they're read.
+    keystr = json.dumps(key)
     res = db.execute(
-        "SELECT response FROM cache WHERE key = ? AND expiry > ?", (keystr, time.time())
+        """
+        SELECT version, response, stored, expiry FROM cache
+        WHERE key = ? AND version = 0 AND expiry > ?
+        """,
+        (keystr, now),
     )
-    row = res.fetchone()
-    if row is not None:
-        return row[0]
+    if (row := res.fetchone()) is None:
+        return None
 
+    data = encode(row["response"])
+    db.execute("DELETE FROM cache WHERE key = ?", (keystr,))
+    db.execute(
+        """
+        REPLACE INTO cache (key, expiry, response, stored, accessed, size, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (keyhash, row["expiry"], data, row["stored"], now, len(data), FORMAT_VERSION),
+    )
+    db.commit()
+
+    return __select(key, keyhash, now)
+
+
+def get_cached_entry(
+    key: dict,
+    namespace: Namespace = DEFAULT,
+    parse: Callable[[str], Any] | None = None,
+) -> CacheEntry | None:
+    """
+    Looks up a cached response. If parse is given, the entry's value is the
+    parsed response; it is kept in memory, so callers must not modify it.
+    """
+    global misses
+
+    keyhash = digest(key)
+    now = time.time()
+
+    entry = memory.get(keyhash)
+    if entry is not None and entry.expiry <= now:
+        memory.pop(keyhash)
+        entry = None
+
+    if entry is not None:
+        hits["memory"] += 1
+    else:
+        row = __select(key, keyhash, now)
+        if row is None:
+            misses += 1
+            return None
+
+        hits["disk"] += 1
+        response = decode(row["version"], row["response"])
+        entry = __MemoryEntry(
+            row["version"],
+            row["response"],
+            len(response),
+            parse(response) if parse is not None else None,
+            row["stored"],
+            row["expiry"],
+        )
+        memory.put(keyhash, entry)
+
+    entry.accessed = now
+    if parse is not None and entry.value is None:
+        entry.value = parse(decode(entry.version, entry.data))
+
+    age = max(0, now - entry.stored)
+    return CacheEntry(
+        entry.version,
+        entry.data,
+        age,
+        age > namespace.soft_ttl,
+        entry.value,
+    )
 
-def __clean_cache(cur=db.cursor()) -> None:
-    cur.execute("DELETE FROM cache WHERE expiry < ?", (time.time(),))
 
+def get_cached(key: dict, namespace: Namespace = DEFAULT) -> str | None:
+    if (entry := get_cached_entry(key, namespace)) is not None:
+        return entry.response
 
-def clean_cache() -> None:
-    __clean_cache(db.cursor())
+
+def contains(key: dict) -> bool:
+    """
+    Reports whether a response is cached, without counting it as a hit or a
+    miss.
+    """
+    keyhash = digest(key)
+    if (entry := memory.entries.get(keyhash)) is not None:
+        return entry.expiry > time.time()
+
+    res = db.execute(
+        "SELECT 1 FROM cache WHERE key = ? AND expiry > ?",
+        (keyhash, time.time()),
+    )
+    return res.fetchone() is not None
+
+
+def set_cache(
+    key: dict,
+    response: str,
+    namespace: Namespace = DEFAULT,
+    value: Any = None,
+) -> None:
+    """
+    Caches a response. If the caller already has it parsed, passing it as
+    value saves parsing it again on the next hit.
+    """
+    keyhash = digest(key)
+    now = time.time()
+    expiry = now + namespace.hard_ttl
+    data = encode(response)
+
+    db.execute(
+        """
+        REPLACE INTO cache (key, expiry, response, stored, accessed, size, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (keyhash, expiry, data, now, now, len(data), FORMAT_VERSION),
+    )
     db.commit()
 
+    memory.put(
+        keyhash,
+        __MemoryEntry(FORMAT_VERSION, data, len(response), value, now, expiry),
+    )
 
-def set_cache(key: dict, response: str, max_age: int = MAX_AGE) -> None:
-    keystr = json.dumps(key)
 
+def sweep() -> None:
+    """
+    Deletes expired rows, then the least recently used rows until the cache
+    database is back under its size cap.
+    """
+    global disk_evictions, expired
+
+    now = time.time()
     cur = db.cursor()
-    cur.execute(
-        "REPLACE INTO cache (key, expiry, response) VALUES (?, ?, ?)",
-        (keystr, time.time() + max_age, response),
+
+    # Hits served from memory never touched the database, so write their
+    # access times back first so they don't look unused.
+    cur.executemany(
+        "UPDATE cache SET accessed = ? WHERE key = ?",
+        [(entry.accessed, key) for key, entry in memory.entries.items()],
     )
-    __clean_cache(cur)
+
+    cur.execute("DELETE FROM cache WHERE expiry < ?", (now,))
+    expired += cur.rowcount
+
+    total = cur.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+    excess = total - DISK_CACHE_BYTES
+    if excess > 0:
+        # Free a little more than needed so we don't sweep again right away.
+        excess += DISK_CACHE_BYTES // 10
+
+        evict = []
+        for row in cur.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if excess <= 0:
+                break
+            evict.append((row[0],))
+            excess -= row[1]
+
+        cur.executemany("DELETE FROM cache WHERE key = ?", evict)
+        disk_evictions += len(evict)
+        for (key,) in evict:
+            memory.pop(key)
+
     db.commit()
 
 
+async def sweep_forever():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as e:
+            print(f"cache sweep failed: {e!r}")
+
+
+def stats() -> CacheStats:
+    return CacheStats(
+        memory_hits=hits["memory"],
+        disk_hits=hits["disk"],
+        misses=misses,
+        memory_evictions=memory.evictions,
+        disk_evictions=disk_evictions,
+        expired=expired,
+        memory_entries=len(memory.entries),
+        memory_bytes=memory.bytes,
+    )
+
+
 def raise_external(e: Exception):
     trace = traceback.format_exc()
     print(f"-------- begin external API error --------")
@@ -78,3 +445,53 @@ def raise_external(e: Exception):
         status_code=500,
         detail=f"external API error: {e} (check server console)",
     )
+
+
+def train(samples: list[str], size: int = 32 * 1024) -> bytes:
+    """
+    Builds a zlib preset dictionary from sample responses. zlib only looks
+    back 32 KiB and finds matches near the end of the dictionary cheapest, so
+    this is whole samples for the nesting, followed by the JSON keys and values
+    that repeat across them with the most common last.
+    """
+    counts: dict[str, int] = {}
+    for sample in samples:
+        for token in set(re.findall(r'"[^"]{1,64}": ?(?:"[^"]{0,32}"|[\w.-]{1,16})?', sample)):
+            counts[token] = counts.get(token, 0) + 1
+
+    common = [t for t, n in counts.items() if n > len(samples) // 2]
+    common.sort(key=lambda t: (counts[t], len(t)))
+    tail = "".join(common).encode()[-size // 2 :]
+
+    # Shortest samples first, so that more of them fit.
+    head = b""
+    for sample in sorted(samples, key=len):
+        if len(head) + len(sample) > size - len(tail):
+            break
+        head += sample.encode()
+
+    return head + tail
+
+
+if __name__ == "__main__":
+    # Trains a new dictionary from the responses currently in the cache and the
+    # example flight details in data/, as the next format version. Searches are
+    # stored as rows of their own (see searches.py), so nearly everything
+    # compressed here is flight details.
+    if len(sys.argv) < 2 or sys.argv[1] != "train":
+        print(f"usage: {sys.argv[0]} train")
+        sys.exit(2)
+
+    from models import FlightDetailResponse
+
+    samples = []
+    with open("data/flight_detail_response_example.json") as f:
+        samples.append(FlightDetailResponse.parse_raw(f.read()).json())
+
+    for row in db.execute("SELECT version, response FROM cache LIMIT 1000"):
+        samples.append(decode(row["version"], row["response"]))
+
+    path = ZDICT_PATH.format(FORMAT_VERSION + 1)
+    with open(path, "wb") as f:
+        f.write(train(samples))
+    print(f"Trained on {len(samples)} responses, wrote {path}")
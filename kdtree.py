@@ -0,0 +1,141 @@
+import math
+import heapq
+from typing import Generic, Iterable, TypeVar
+
+T = TypeVar("T")
+
+EARTH_RADIUS = 6371  # km, same as flights.calculate_distance
+
+Point = tuple[float, float, float]
+
+
+def to_unit(lat: float, long: float) -> Point:
+    """
+    Converts a latitude and longitude in degrees to a point on the unit sphere.
+    """
+    lat = math.radians(lat)
+    long = math.radians(long)
+    return (
+        math.cos(lat) * math.cos(long),
+        math.cos(lat) * math.sin(long),
+        math.sin(lat),
+    )
+
+
+def chord_to_km(chord: float) -> float:
+    """
+    Converts a straight-line distance between two points on the unit sphere
+    into the great-circle distance along the Earth's surface. This is exactly
+    the distance the Haversine formula computes.
+    """
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km: float) -> float:
+    return 2 * math.sin(min(math.pi, km / EARTH_RADIUS) / 2)
+
+
+def _dist2(a: Point, b: Point) -> float:
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    dz = a[2] - b[2]
+    return dx * dx + dy * dy + dz * dz
+
+
+class KDTree(Generic[T]):
+    """
+    A static 3-d tree over points on the unit sphere. Ranking points by their
+    chord length is the same as ranking them by great-circle distance, so the
+    tree answers nearest-neighbor queries without any special cases for the
+    poles or the antimeridian.
+
+    The tree is stored implicitly: the subtree covering points[lo:hi] has its
+    splitting point at the middle index, split on axis depth % 3.
+    """
+
+    __slots__ = ("points", "items")
+
+    points: list[Point]
+    items: list[T]
+
+    def __init__(self, items: Iterable[tuple[float, float, T]]):
+        entries = [(to_unit(lat, long), item) for lat, long, item in items]
+        self.__build(entries, 0, len(entries), 0)
+
+        self.points = [entry[0] for entry in entries]
+        self.items = [entry[1] for entry in entries]
+
+    def __build(self, entries: list, lo: int, hi: int, depth: int):
+        if hi - lo <= 1:
+            return
+
+        axis = depth % 3
+        entries[lo:hi] = sorted(entries[lo:hi], key=lambda e: e[0][axis])
+
+        mid = (lo + hi) // 2
+        self.__build(entries, lo, mid, depth + 1)
+        self.__build(entries, mid + 1, hi, depth + 1)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def nearest(
+        self,
+        lat: float,
+        long: float,
+        k: int,
+        max_km: float | None = None,
+    ) -> list[tuple[T, float]]:
+        """
+        Returns up to k items closest to the given coordinates, optionally
+        only those within max_km, as (item, distance in km) pairs sorted by
+        distance.
+        """
+        if k <= 0:
+            return []
+
+        q = to_unit(lat, long)
+        bound = math.inf if max_km is None else km_to_chord(max_km) ** 2
+
+        # Max-heap of the best k points so far, as (-dist2, index).
+        heap: list[tuple[float, int]] = []
+        self.__nearest(q, 0, len(self.points), 0, k, bound, heap)
+
+        heap.sort(reverse=True)
+        return [(self.items[i], chord_to_km(math.sqrt(-d2))) for d2, i in heap]
+
+    def __nearest(
+        self,
+        q: Point,
+        lo: int,
+        hi: int,
+        depth: int,
+        k: int,
+        bound: float,
+        heap: list[tuple[float, int]],
+    ):
+        if lo >= hi:
+            return
+
+        mid = (lo + hi) // 2
+        p = self.points[mid]
+
+        d2 = _dist2(q, p)
+        if d2 <= bound:
+            if len(heap) < k:
+                heapq.heappush(heap, (-d2, mid))
+            elif d2 < -heap[0][0]:
+                heapq.heapreplace(heap, (-d2, mid))
+
+        axis = depth % 3
+        diff = q[axis] - p[axis]
+        if diff < 0:
+            near, far = (lo, mid), (mid + 1, hi)
+        else:
+            near, far = (mid + 1, hi), (lo, mid)
+
+        self.__nearest(q, *near, depth + 1, k, bound, heap)
+
+        worst = -heap[0][0] if len(heap) == k else bound
+        if diff * diff <= worst:
+            self.__nearest(q, *far, depth + 1, k, bound, heap)
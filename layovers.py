@@ -1,134 +1,424 @@
-from datetime import date as Date, datetime, timedelta
+import json
+import time
+import base64
+import calendar
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, NamedTuple
 
-from models import Flight, FlightDetailResponse, LayoverDb, UserResponse
+from models import LayoverMatch, UserResponse
 from db import db
 
+# Two layovers match if both people are at the airport at the same time for at
+# least this long.
 MIN_DIFF = timedelta(minutes=30)
 
+# Longest layover that can be added. Matching relies on this to only look at
+# layovers that leave within MAX_LAYOVER of the user getting there, so that
+# the scan over layovers_overlap_idx has an end. Longer layovers stored before
+# this was enforced were cut to it by a migration in db.py.
+MAX_LAYOVER = timedelta(days=7)
 
-def set_popularity_for_flights(flights: list[FlightDetailResponse]):
-    for flight in flights:
-        assert flight.data is not None
-        flight.data.pop_score = 0
 
-    iatas = []
-    iata_flights = [[] for i in range(len(flights))]
-    for i in range(len(flights)):
-        flight = flights[i]
-        if flight is None or flight.data is None or flight.data.legs is None:
-            continue
+# Layovers count towards how popular an airport is right now half as much
+# for every HALF_LIFE they are away from now, and not at all past HORIZON.
+HALF_LIFE = timedelta(days=30)
+HORIZON = 8 * HALF_LIFE
+
+# How often decayed popularity is recomputed as time moves on.
+DECAY_REFRESH = 10 * 60  # seconds
+
+# Layover counts and decayed popularity by airport, as read from
+# airport_popularity and airport_hours. Airports are dropped from them when
+# this process changes their layovers, and all of them when some other
+# connection writes to the database.
+__popularity: dict[str, int] = {}
+__decayed: dict[str, float] = {}
+__decayed_at = 0.0
+__popularity_generation = 0
+__data_version: int | None = None
+
+
+def hour_of(t: datetime) -> int:
+    """
+    Returns the hour t is in, in hours since the Unix epoch, like airport_hours
+    has them. Times without a timezone are taken to be in UTC, as SQLite does.
+    """
+    return calendar.timegm(t.utctimetuple()) // 3600
+
+
+def in_utc(t: datetime) -> datetime:
+    """
+    Returns t in UTC, which is how layovers are stored so that their times
+    compare as strings. Times without a timezone are taken to be in UTC, as
+    SQLite does.
+    """
+    if t.tzinfo is None:
+        return t.replace(tzinfo=timezone.utc)
+    return t.astimezone(timezone.utc)
+
 
-        for leg in flight.data.legs:
-            if leg is None or leg.layovers is None:
-                continue
+def __check_data_version(cur):
+    global __data_version
 
-            for layover in leg.layovers:
-                iatas.append(layover.destination.displayCode)
-                iata_flights[i].append(layover.destination.displayCode)
+    data_version = cur.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != __data_version:
+        popularity_changed()
+        __data_version = data_version
+
+
+def get_popularity(iatas: Iterable[str]) -> dict[str, int]:
+    """
+    Returns how many layovers there are at each of the given airports. Airports
+    without any are left out.
+    """
+    iatas = set(iatas)
+    if not iatas:
+        return {}
 
     cur = db.cursor()
-    res = cur.execute(
-        f"""
-            SELECT iata_code, COUNT(*) FROM layovers
-            WHERE iata_code IN ( {', '.join(['?'] * len(iatas))} )
-            GROUP BY iata_code
-        """,
-        iatas,
-    )
+    __check_data_version(cur)
+
+    counts = {iata: __popularity.get(iata) for iata in iatas}
+    missing = [iata for iata, n in counts.items() if n is None]
+    if missing:
+        generation = __popularity_generation
+        res = cur.execute(
+            f"""
+                SELECT iata_code, layovers FROM airport_popularity
+                WHERE iata_code IN ( {', '.join(['?'] * len(missing))} )
+            """,
+            missing,
+        )
+        found = {iata: 0 for iata in missing} | dict(res.fetchall())
+        counts.update(found)
 
-    rows = res.fetchall()
-    if rows is None:
-        return
+        # Don't cache counts that changed while they were being read.
+        if generation == __popularity_generation:
+            __popularity.update(found)
 
-    # convert rows into a dict
-    popularity = {}
-    for row in rows:
-        popularity[row[0]] = row[1]
+    return {iata: n for iata, n in counts.items() if n}
 
-    for i in range(len(flights)):
-        flight = flights[i]
-        assert flight.data is not None
 
-        for iata in iata_flights[i]:
-            if iata in popularity:
-                flight.data.pop_score += popularity[iata]
+def get_decayed_popularity(iatas: Iterable[str]) -> dict[str, float]:
+    """
+    Returns how popular each of the given airports is around now: its layovers
+    weighted by how close to now they start. Airports without any are left
+    out.
+    """
+    global __decayed_at
 
+    iatas = set(iatas)
+    if not iatas:
+        return {}
 
-def get_users_in_layover(user_id: str, iata_code: str):
     cur = db.cursor()
-    res = cur.execute(
-        """
-            SELECT user_id, iata_code, arrive, depart FROM layovers
-            WHERE iata_code = ?
-            AND user_id = ?
+    __check_data_version(cur)
+    if time.time() - __decayed_at > DECAY_REFRESH:
+        __decayed.clear()
+        __decayed_at = time.time()
+
+    scores = {iata: __decayed.get(iata) for iata in iatas}
+    missing = [iata for iata, n in scores.items() if n is None]
+    if missing:
+        generation = __popularity_generation
+        now = hour_of(datetime.utcnow())
+        half_life = HALF_LIFE / timedelta(hours=1)
+        horizon = int(HORIZON / timedelta(hours=1))
+
+        found = {iata: 0.0 for iata in missing}
+        res = cur.execute(
+            f"""
+                SELECT iata_code, hour, arrivals FROM airport_hours
+                WHERE iata_code IN ( {', '.join(['?'] * len(missing))} )
+                AND hour BETWEEN ? AND ? AND arrivals > 0
+            """,
+            (*missing, now - horizon, now + horizon),
+        )
+        for iata, hour, arrivals in res:
+            found[iata] += arrivals * 0.5 ** (abs(hour - now) / half_life)
+        scores.update(found)
+
+        if generation == __popularity_generation:
+            __decayed.update(found)
+
+    return {iata: n for iata, n in scores.items() if n}
+
+
+def get_occupancy(
+    iatas: Iterable[str],
+    start: int,
+    end: int,
+) -> dict[str, dict[int, int]]:
+    """
+    Returns how many layovers are on at each of the given airports during
+    each hour from start up to end, in hours since the Unix epoch. Hours
+    without any are left out.
+    """
+    iatas = list(set(iatas))
+    if not iatas:
+        return {}
+
+    occupancy: dict[str, dict[int, int]] = {}
+    res = db.execute(
+        f"""
+            SELECT iata_code, hour, present FROM airport_hours
+            WHERE iata_code IN ( {', '.join(['?'] * len(iatas))} )
+            AND hour >= ? AND hour < ? AND present > 0
         """,
-        (iata_code, user_id),
+        (*iatas, start, end),
     )
+    for iata, hour, present in res:
+        occupancy.setdefault(iata, {})[hour] = present
 
-    row = res.fetchone()
-    if row is None:
-        return []
+    return occupancy
 
-    curr_user = LayoverDb(
-        user_id=row[0],
-        iata_code=row[1],
-        arrive=row[2],
-        depart=row[3],
+
+def get_window_popularity(windows: list[list[tuple[str, int, int]]]) -> list[int]:
+    """
+    Scores itineraries by how many people are there when they are. Each one
+    is given as the (IATA code, first hour, last hour) of each of its stops,
+    and scores the most people on at each stop at once during those hours,
+    summed over its stops.
+    """
+    stops = [stop for stop_windows in windows for stop in stop_windows]
+    if not stops:
+        return [0] * len(windows)
+
+    occupancy = get_occupancy(
+        (iata for iata, _, _ in stops),
+        min(start for _, start, _ in stops),
+        max(end for _, _, end in stops) + 1,
     )
 
-    other_res = cur.execute(
+    def peak(iata: str, start: int, end: int) -> int:
+        hours = occupancy.get(iata, {})
+        return max((hours.get(h, 0) for h in range(start, end + 1)), default=0)
+
+    return [sum(peak(*stop) for stop in stop_windows) for stop_windows in windows]
+
+
+def popularity_changed(iatas: Iterable[str] | None = None):
+    """
+    Drops the cached popularity of the given airports, or of all of them. Call
+    after committing changes to their layovers.
+    """
+    global __popularity_generation
+
+    __popularity_generation += 1
+    if iatas is None:
+        __popularity.clear()
+        __decayed.clear()
+    else:
+        for iata in iatas:
+            __popularity.pop(iata, None)
+            __decayed.pop(iata, None)
+
+
+class MatchCursor(NamedTuple):
+    """
+    Where a page of matches ended: the user's layover and the other layover of
+    its last match, with times as they're stored. The next page starts right
+    after it.
+    """
+
+    iata_code: str
+    arrive: str
+    depart: str
+    other_depart: str
+    other_arrive: str
+    other_user_id: str
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(json.dumps(self).encode()).decode()
+
+    @classmethod
+    def decode(cls, s: str) -> "MatchCursor":
+        try:
+            fields = json.loads(base64.urlsafe_b64decode(s))
+            if len(fields) != len(cls._fields):
+                raise ValueError
+            if not all(isinstance(f, str) for f in fields):
+                raise ValueError
+        except Exception:
+            raise ValueError("invalid cursor")
+        return cls(*fields)
+
+
+def __stored(t: datetime) -> str:
+    # Same format sqlite3 stores datetimes in, so that the times compare as
+    # strings the same way they do as times.
+    return in_utc(t).isoformat(" ")
+
+
+def __overlapping(
+    cur,
+    user_id: str,
+    iata_code: str,
+    arrive: datetime,
+    depart: datetime,
+    start: tuple[str, str, str],
+    limit: int,
+) -> list:
+    # Overlapping by MIN_DIFF means leaving at least MIN_DIFF after the user
+    # gets there, getting there at least MIN_DIFF before the user leaves, and
+    # staying at least MIN_DIFF. Since no layover is longer than MAX_LAYOVER,
+    # getting there before the user leaves also means leaving before
+    # MAX_LAYOVER after that, which bounds the range of depart to scan.
+    return cur.execute(
         """
             SELECT
+                layovers.depart,
+                layovers.arrive,
                 users.id,
                 users.email,
                 users.first_name,
-                users.profile_picture,
-                arrive,
-                depart
-            FROM layovers
-            JOIN users ON layovers.user_id = users.id
-            WHERE iata_code = ? AND user_id != ?
-            AND arrive <= ? OR depart >= ?
-            GROUP BY user_id
+                users.profile_picture
+            FROM layovers INDEXED BY layovers_overlap_idx
+            JOIN users ON users.id = layovers.user_id
+            WHERE layovers.iata_code = ?
+            AND layovers.depart >= ?
+            AND layovers.depart <= ?
+            AND layovers.arrive <= ?
+            AND layovers.user_id != ?
+            AND strftime('%s', layovers.depart) - strftime('%s', layovers.arrive) >= ?
+            AND (layovers.depart, layovers.arrive, layovers.user_id) > (?, ?, ?)
+            ORDER BY layovers.depart, layovers.arrive, layovers.user_id
+            LIMIT ?
         """,
-        (iata_code, user_id, curr_user.depart, curr_user.arrive),
-    )
+        (
+            iata_code,
+            __stored(arrive + MIN_DIFF),
+            __stored(depart - MIN_DIFF + MAX_LAYOVER),
+            __stored(depart - MIN_DIFF),
+            user_id,
+            int(MIN_DIFF.total_seconds()),
+            *start,
+            limit,
+        ),
+    ).fetchall()
 
-    rows = other_res.fetchall()
-    if rows is None:
-        return []
 
-    users = [UserResponse(**r) for r in rows if r[0] != user_id]
+def find_matches(
+    user_id: str,
+    iata_code: str | None = None,
+    limit: int = 50,
+    after: MatchCursor | None = None,
+) -> tuple[list[LayoverMatch], MatchCursor | None]:
+    """
+    Finds the other users who are at the same airport as the user for at least
+    MIN_DIFF during any of the user's layovers, or only those at iata_code.
+    Matches are ordered by the user's layover and then by when the other
+    person leaves. Returns up to limit of them, and a cursor for the rest if
+    there are more.
+
+    Each of the user's layovers is one walk over layovers_overlap_idx, which
+    starts at the layovers at that airport that haven't ended by the time the
+    user gets there and stops after limit matches, or at the last layover that
+    could have started before the user leaves.
+    """
+    cur = db.cursor()
+    mine = cur.execute(
+        """
+            SELECT iata_code, arrive, depart FROM layovers
+            WHERE user_id = ? AND (? IS NULL OR iata_code = ?)
+            ORDER BY iata_code, arrive, depart
+        """,
+        (user_id, iata_code, iata_code),
+    ).fetchall()
+
+    matches: list[LayoverMatch] = []
+    last: MatchCursor | None = None
+    for iata, arrive, depart in mine:
+        if after is not None and (iata, arrive, depart) < after[:3]:
+            continue
+
+        arrive_at = datetime.fromisoformat(arrive)
+        depart_at = datetime.fromisoformat(depart)
+        if depart_at - arrive_at < MIN_DIFF:
+            continue
+
+        start = ("", "", "")
+        if after is not None and (iata, arrive, depart) == after[:3]:
+            start = after[3:]
+
+        rows = __overlapping(
+            cur, user_id, iata, arrive_at, depart_at, start, limit + 1 - len(matches)
+        )
+
+        for row in rows:
+            if len(matches) == limit:
+                return matches, last
+
+            matches.append(
+                LayoverMatch(
+                    iata=iata,
+                    arrive=arrive,
+                    depart=depart,
+                    user=UserResponse(**row),
+                    user_arrive=row["arrive"],
+                    user_depart=row["depart"],
+                )
+            )
+            last = MatchCursor(
+                iata, arrive, depart, row["depart"], row["arrive"], row["id"]
+            )
+
+    return matches, None
+
 
-    times = {}
-    for row in rows:
-        times[row[0]] = (
-            datetime.fromisoformat(row[4]),
-            datetime.fromisoformat(row[5]),
+def find_overlapping(
+    user_id: str,
+    iata_code: str,
+    arrive: datetime,
+    depart: datetime,
+    limit: int = 10000,
+) -> list[LayoverMatch]:
+    """
+    Finds the layovers of other users that overlap the given one the same way
+    find_matches does, whether or not the user has the given one, earliest to
+    leave first.
+    """
+    if depart - arrive < MIN_DIFF:
+        return []
+
+    rows = __overlapping(
+        db.cursor(), user_id, iata_code, arrive, depart, ("", "", ""), limit
+    )
+    return [
+        LayoverMatch(
+            iata=iata_code,
+            arrive=arrive,
+            depart=depart,
+            user=UserResponse(**row),
+            user_arrive=row["arrive"],
+            user_depart=row["depart"],
         )
+        for row in rows
+    ]
+
 
-    matching = []
+def get_users_in_layover(
+    user_id: str,
+    iata_code: str,
+    limit: int = 50,
+    after: MatchCursor | None = None,
+) -> tuple[list[UserResponse], MatchCursor | None]:
+    """
+    Returns the other users whose layovers at the airport overlap the user's,
+    each once per page, and a cursor for the next page if there is one.
+    """
+    matches, next = find_matches(user_id, iata_code, limit, after)
 
-    for user in users:
-        # if other departs after you arrive
-        if (
-            times[user.id][1] > curr_user.arrive
-            and times[user.id][1] - curr_user.arrive >= MIN_DIFF
-        ):
-            matching.append(user)
-        # if other arrives before you depart
-        elif (
-            times[user.id][0] < curr_user.depart
-            and curr_user.depart - times[user.id][0] >= MIN_DIFF
-        ):
-            matching.append(user)
+    users: dict[str, UserResponse] = {}
+    for match in matches:
+        users.setdefault(match.user.id, match.user)
 
-    return matching
+    return list(users.values()), next
 
 
 if __name__ == "__main__":
     # other 7055876208000499712
-    users = get_users_in_layover("7055837737219260416", "LAX")
+    users, _ = get_users_in_layover("7055837737219260416", "LAX")
 
     assert users is not None
     assert len(users) > 0
@@ -16,6 +16,8 @@ from pyrate_limiter import (
 WORKING_DIR = os.path.join(tempfile.gettempdir(), "layover-party")
 LIMITER_DB = os.path.join(WORKING_DIR, "limiter.db")
 
+os.makedirs(WORKING_DIR, exist_ok=True)
+
 Rate = RequestRate
 Duration = Duration
 LimitedException = BucketFullException
@@ -38,6 +40,19 @@ def raise_http(full_err: BucketFullException):
     )
 
 
+def available(limiter: Limiter, identity: str) -> int:
+    """
+    Returns roughly how many more calls the identity can make under the
+    limiter's longest rate before it would have to wait. Expired calls are only
+    cleared out when the next one is made, so this errs on the low side.
+    """
+    rate = limiter._rates[-1]
+    bucket = limiter.bucket_group.get(identity)
+    if bucket is None:
+        return rate.limit
+    return max(0, rate.limit - bucket.size())
+
+
 async def wait(*ctx_funcs: Callable[[], LimitContextDecorator]):
     for ctx_func in ctx_funcs:
         # this library is poo and does not do async properly
@@ -1,11 +1,14 @@
-from datetime import date as Date
+from datetime import date as Date, datetime, timedelta, timezone
 import asyncio
 import os
+import json
 import base64
 import bcrypt
 import time
+import math
 import hashlib
-from typing import cast, Annotated
+from typing import Annotated
+from contextlib import asynccontextmanager
 
 from sqlite3 import IntegrityError
 from dotenv import load_dotenv
@@ -15,25 +18,50 @@ from fastapi import (
     HTTPException,
     Response,
     Query,
+    Request,
     UploadFile,
+    WebSocket,
 )
+from fastapi.responses import StreamingResponse
 from mimetypes import MimeTypes
 from snowflake import SnowflakeGenerator
 
+import budget
+import fanout
 import httputil
 import limiter
+import notify
+import prefetch
+import searches
+import sessions
+import upstream
 from db import db
-from deps import get_authorized_user
+from deps import get_authorized_user, get_admin_user, get_user_by_token
 from models import *
 from flights import (
     fetch_flight_details,
-    fetch_flights,
-    fetch_flight_details,
+    flight_searches,
+    flight_details,
+    DetailFragment,
+    SEARCH_CACHE,
+    DETAILS_CACHE,
+)
+from layovers import (
+    find_matches,
+    get_decayed_popularity,
+    get_occupancy,
+    get_popularity,
+    get_users_in_layover,
+    hour_of,
+    popularity_changed,
+    in_utc,
+    MatchCursor,
+    MAX_LAYOVER,
 )
-from layovers import set_popularity_for_flights, get_users_in_layover
 from airports import (
     find_by_name as find_airports_by_name,
     find_by_coords as find_airports_by_coords,
+    find_in_box as find_airports_in_box,
     get_by_iata as get_airport_by_iata,
 )
 
@@ -44,10 +72,20 @@ TOKEN_EXPIRY = 604800  # 1 week
 MAX_UPLOAD_SIZE = 1024 * 1024 * 1  # 1 MB
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upstream.start()
+    sweeper = asyncio.create_task(httputil.sweep_forever())
+    yield
+    sweeper.cancel()
+    await upstream.close()
+
+
 app = FastAPI(
     docs_url="/api/docs",
     redoc_url="/api/redoc",
     openapi_url="/api/openapi.json",
+    lifespan=lifespan,
 )
 
 
@@ -199,8 +237,124 @@ def get_user(id: str) -> UserResponse:
     return UserResponse(**row)
 
 
-@app.get("/api/flights")
-async def get_flights(
+def __details_cache_key(
+    itinerary_id: str, origin: str, dest: str, date: Date, return_date: Date
+) -> dict:
+    return {
+        "itineraryId": itinerary_id,
+        "origin": origin,
+        "dest": dest,
+        "date": str(date),
+        "return_date": str(return_date),
+    }
+
+
+async def __fetch_details(
+    cacheKey: dict,
+    itinerary_id: str,
+    origin: str,
+    dest: str,
+    date: Date,
+    return_date: Date,
+    num_adults: int,
+    user_id: str,
+) -> DetailFragment:
+    async def fetch_details() -> DetailFragment:
+        res = await fetch_flight_details(
+            itineraryId=itinerary_id,
+            origin=origin,
+            dest=dest,
+            date=date,
+            return_date=return_date,
+            num_adults=num_adults,
+            user_id=user_id,
+        )
+        fragment = DetailFragment.of(res)
+        if res.status:
+            httputil.set_cache(cacheKey, res.json(), DETAILS_CACHE, fragment)
+        return fragment
+
+    return await flight_details.do(cacheKey, fetch_details)
+
+
+async def __prefetch_details(
+    itinerary_ids: list[str],
+    origin: str,
+    dest: str,
+    date: Date,
+    return_date: Date,
+    num_adults: int,
+    user_id: str,
+):
+    # One at a time and only while there's budget and rate limit to spare,
+    # so prefetching never gets in the way of pages being asked for.
+    for itinerary_id in itinerary_ids:
+        cacheKey = __details_cache_key(itinerary_id, origin, dest, date, return_date)
+        if httputil.contains(cacheKey) or flight_details.is_running(cacheKey):
+            continue
+        if not prefetch.allowed(user_id):
+            return
+
+        prefetch.track(cacheKey)
+        await __fetch_details(
+            cacheKey,
+            itinerary_id,
+            origin,
+            dest,
+            date,
+            return_date,
+            num_adults,
+            user_id,
+        )
+
+
+def __log_background_error(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()) is not None:
+        print(f"background task failed: {e!r}")
+
+
+class FlightsPage:
+    """
+    One page of a flight search, resolved up to the itineraries on it. Both
+    flight endpoints take this as a dependency and differ in how they send
+    the details.
+    """
+
+    PAGE_SIZE = 5
+
+    def __init__(
+        self,
+        user_id: str,
+        origin: str,
+        dest: str,
+        date: Date,
+        return_date: Date,
+        num_adults: int,
+        sort: searches.Sort,
+        search_cache_key: dict,
+        ids: list[str],
+        count: int,
+        next: searches.Cursor | None,
+        headers: dict[str, str],
+        fetches_left: int,
+    ):
+        self.user_id = user_id
+        self.origin = origin
+        self.dest = dest
+        self.date = date
+        self.return_date = return_date
+        self.num_adults = num_adults
+        self.sort = sort
+        self.search_cache_key = search_cache_key
+        self.ids = ids
+        self.count = count
+        self.next = next
+        self.headers = headers
+        # Details we may still fetch from upstream, see budget.BudgetState.
+        self.fetches_left = fetches_left
+
+
+async def __get_flights_page(
     user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
     origin: Annotated[str, Query(description="3-letter airport code (IATA)")],
     dest: Annotated[str, Query(description="3-letter airport code (IATA)")],
@@ -215,36 +369,68 @@ async def get_flights(
         int, Query(description="max wait time in milliseconds", ge=0, le=5000)
     ] = 500,
     page: Annotated[int, Query(description="page number", ge=1)] = 1,
-) -> list[FlightDetailResponse]:
-    PAGE_SIZE = 5
-
+    sort: Annotated[
+        searches.Sort, Query(description="what to order the flights by")
+    ] = "layover_hours",
+    cursor: Annotated[
+        str | None,
+        Query(description="X-Next-Cursor of the previous page; overrides page"),
+    ] = None,
+) -> FlightsPage:
     validate_iata(origin, dest)
 
     if date > return_date:
         raise HTTPException(status_code=400, detail="Invalid dates")
 
-    search_cache_key = {
-        "origin": origin,
-        "dest": dest,
-        "date": str(date),
-        "return_date": str(return_date),
-    }
+    # Whatever the user was prefetching, they've moved on from it.
+    prefetch.cancel(user.id)
 
-    search: FlightApiResponse
-    # TODO: implement eviction for old cached flights
-    if (search_data := httputil.get_cached(search_cache_key)) is not None:
-        search = FlightApiResponse.parse_raw(search_data)
+    after = None
+    if cursor is not None:
+        try:
+            after = searches.Cursor.decode(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if after.sort != sort:
+            raise HTTPException(status_code=400, detail="Cursor is for another sort")
+
+    search_cache_key = searches.key(origin, dest, date, return_date)
+
+    def search_flights():
+        return searches.fetch(
+            origin, dest, date, return_date, num_adults, wait_time, user.id
+        )
+
+    spend = budget.state()
+    headers = {}
+
+    if (cached := searches.get(search_cache_key, SEARCH_CACHE)) is not None:
+        count = cached.value["count"]
+
+        # Serve stale searches right away, but refresh them for next time.
+        # Only one refresh per search runs at a time, and none while a session
+        # is polling for it, since that would replace the merged results.
+        if (
+            cached.stale
+            and spend.mode != "cache_only"
+            and not sessions.is_running(search_cache_key)
+        ):
+            refresh = flight_searches.start(search_cache_key, search_flights)
+            refresh.add_done_callback(__log_background_error)
+
+        headers["Age"] = str(int(cached.age))
+        headers["X-Cache"] = "STALE" if cached.stale else "HIT"
+    elif spend.mode == "cache_only":
+        raise HTTPException(
+            status_code=503,
+            detail="Flight search is limited to cached results for the rest of the month",
+        )
     else:
         try:
-            search = await fetch_flights(
-                origin,
-                dest,
-                date,
-                return_date,
-                num_adults,
-                wait_time,
-                user.id,
-            )
+            search = await flight_searches.do(search_cache_key, search_flights)
+            # Searches upstream didn't finish aren't stored, so there are no
+            # rows to page through.
+            count = len(search.data or []) if search.status else 0
         except HTTPException as e:
             raise e
         except limiter.LimitedException as e:
@@ -252,62 +438,372 @@ async def get_flights(
         except Exception as e:
             httputil.raise_external(e)
 
-        if search.status:
-            httputil.set_cache(search_cache_key, search.json())
+        headers["Age"] = "0"
+        headers["X-Cache"] = "MISS"
 
-    if search is None or search.data is None:
-        raise HTTPException(status_code=404, detail="No flights found")
+    # Only this page's rows are read, in the order asked for.
+    ids, next = searches.page(
+        search_cache_key,
+        sort,
+        FlightsPage.PAGE_SIZE,
+        offset=(page - 1) * FlightsPage.PAGE_SIZE if after is None else 0,
+        after=after,
+    )
 
-    start = (page - 1) * PAGE_SIZE
-    end = start + PAGE_SIZE
-    search.data = search.data[start:end]
+    headers["X-Total-Count"] = str(count)
+    if next is not None:
+        headers["X-Next-Cursor"] = next.encode()
+
+    return FlightsPage(
+        user_id=user.id,
+        origin=origin,
+        dest=dest,
+        date=date,
+        return_date=return_date,
+        num_adults=num_adults,
+        sort=sort,
+        search_cache_key=search_cache_key,
+        ids=ids,
+        count=count,
+        next=next,
+        headers=headers,
+        # When we're spending the monthly budget too fast, only fetch some of
+        # the details that aren't cached; the rest are left out of the page.
+        fetches_left=math.ceil(len(ids) * spend.detail_fanout),
+    )
 
-    details: list[FlightDetailResponse | None] = [None] * len(search.data)
 
-    async def loop(i):
-        assert search.data is not None
+async def __get_page_detail(page: FlightsPage, i: int) -> DetailFragment | None:
+    """
+    Returns the detail of the i-th itinerary of the page, or None if it isn't
+    cached and the budget doesn't allow fetching it.
+    """
+    cacheKey = __details_cache_key(
+        page.ids[i], page.origin, page.dest, page.date, page.return_date
+    )
+    prefetch.used(cacheKey)
 
-        cacheKey = {
-            "itineraryId": search.data[i].id,
-            "origin": origin,
-            "dest": dest,
-            "date": str(date),
-            "return_date": str(return_date),
-        }
+    if (
+        cached := httputil.get_cached_entry(
+            cacheKey, DETAILS_CACHE, DetailFragment.parse
+        )
+    ) is not None:
+        return cached.value
 
-        if (cache := httputil.get_cached(cacheKey)) is not None:
-            details[i] = FlightDetailResponse.parse_raw(cache)
-            return
+    if page.fetches_left <= 0:
+        return None
+    page.fetches_left -= 1
 
+    try:
+        return await __fetch_details(
+            cacheKey,
+            page.ids[i],
+            page.origin,
+            page.dest,
+            page.date,
+            page.return_date,
+            page.num_adults,
+            page.user_id,
+        )
+    except HTTPException as e:
+        raise e
+    except limiter.LimitedException as e:
+        limiter.raise_http(e)
+    except Exception as e:
+        httputil.raise_external(e)
+
+
+def __get_pop_scores(fragments: list[DetailFragment | None]) -> list[int | None]:
+    popularity = get_decayed_popularity(
+        iata for f in fragments if f is not None for iata in f.layovers
+    )
+    return [
+        round(sum(popularity.get(iata, 0) for iata in f.layovers))
+        if f is not None
+        else None
+        for f in fragments
+    ]
+
+
+def __start_prefetch(page: FlightsPage):
+    # Warm up the next page while the user looks at this one.
+    if page.next is None:
+        return
+
+    next_ids, _ = searches.page(
+        page.search_cache_key, page.sort, FlightsPage.PAGE_SIZE, after=page.next
+    )
+    prefetch.start(
+        page.user_id,
+        lambda: __prefetch_details(
+            next_ids,
+            page.origin,
+            page.dest,
+            page.date,
+            page.return_date,
+            page.num_adults,
+            page.user_id,
+        ),
+    )
+
+
+@app.get("/api/flights", response_model=list[FlightDetailResponse])
+async def get_flights(
+    page: Annotated[FlightsPage, Depends(__get_flights_page)],
+) -> Response:
+    details = await asyncio.gather(
+        *(__get_page_detail(page, i) for i in range(len(page.ids)))
+    )
+    __start_prefetch(page)
+
+    # Cached details are already serialized, so the page is put together from
+    # their bytes with only the popularity scores filled in. This skips
+    # validating and serializing the response model, which is still what the
+    # response looks like.
+    fragments = [detail for detail in details if detail is not None]
+    scores = __get_pop_scores(fragments)
+
+    body = b",".join(f.render(score) for f, score in zip(fragments, scores))
+    return Response(
+        b"[" + body + b"]", media_type="application/json", headers=page.headers
+    )
+
+
+@app.get("/api/flights/stream")
+async def stream_flights(
+    request: Request,
+    page: Annotated[FlightsPage, Depends(__get_flights_page)],
+) -> StreamingResponse:
+    """
+    Same as /api/flights, but streams the page as events while its details
+    are fetched, as newline-delimited JSON or as server-sent events if the
+    client accepts text/event-stream. Events, each with its name as "event":
+
+    - skeleton: the page's itinerary IDs in order, the total result count
+      and the next cursor, sent before any detail.
+    - detail: the detail response of the itinerary at index, in whatever
+      order they resolve. Its pop_score is null until the popularity event.
+    - error: the detail at index couldn't be fetched; status and detail are
+      what /api/flights would have failed with.
+    - skipped: the detail at index wasn't fetched to save the monthly budget.
+    - popularity: the pop_score of each itinerary by index, sent last.
+    """
+    sse = "text/event-stream" in request.headers.get("accept", "")
+
+    def event(name: str, payload: bytes) -> bytes:
+        if sse:
+            return b"event: " + name.encode() + b"\ndata: " + payload + b"\n\n"
+        return payload + b"\n"
+
+    def json_event(name: str, **fields) -> bytes:
+        return event(name, json.dumps({"event": name, **fields}).encode())
+
+    async def resolve(i: int):
         try:
-            res = await fetch_flight_details(
-                itineraryId=search.data[i].id,
-                origin=origin,
-                dest=dest,
-                date=date,
-                return_date=return_date,
-                num_adults=num_adults,
-                user_id=user.id,
-            )
+            return i, await __get_page_detail(page, i), None
         except HTTPException as e:
-            raise e
-        except limiter.LimitedException as e:
-            limiter.raise_http(e)
-        except Exception as e:
-            httputil.raise_external(e)
+            return i, None, e
+
+    async def events():
+        yield json_event(
+            "skeleton",
+            itineraries=page.ids,
+            total=page.count,
+            next_cursor=page.next.encode() if page.next is not None else None,
+        )
 
-        if res.status:
-            httputil.set_cache(cacheKey, res.json())
+        fragments: list[DetailFragment | None] = [None] * len(page.ids)
+        tasks = [asyncio.ensure_future(resolve(i)) for i in range(len(page.ids))]
+        try:
+            for resolved in asyncio.as_completed(tasks):
+                i, fragment, error = await resolved
+                if error is not None:
+                    yield json_event(
+                        "error",
+                        index=i,
+                        itinerary_id=page.ids[i],
+                        status=error.status_code,
+                        detail=error.detail,
+                    )
+                elif fragment is None:
+                    yield json_event("skipped", index=i, itinerary_id=page.ids[i])
+                else:
+                    fragments[i] = fragment
+                    # The detail is spliced in as it was cached, unparsed.
+                    yield event(
+                        "detail",
+                        b'{"event": "detail", "index": %d, "itinerary_id": %s, "detail": %s}'
+                        % (i, json.dumps(page.ids[i]).encode(), fragment.render(None)),
+                    )
+        finally:
+            # The client went away; shared fetches keep going on their own.
+            for task in tasks:
+                task.cancel()
+
+        __start_prefetch(page)
+        yield json_event("popularity", scores=__get_pop_scores(fragments))
+
+    headers = dict(page.headers)
+    if sse:
+        headers["Cache-Control"] = "no-cache"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers=headers,
+    )
 
-        details[i] = res
 
-    coros = [loop(i) for i in range(len(search.data))]
-    await asyncio.gather(*coros)
+@app.get("/api/flights/flexible")
+async def search_flexible_flights(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    origin: Annotated[str, Query(description="3-letter airport code (IATA)")],
+    dest: Annotated[str, Query(description="3-letter airport code (IATA)")],
+    date: Annotated[
+        Date, Query(description="date of first flight in YYYY-MM-DD format")
+    ],
+    return_date: Annotated[
+        Date, Query(description="date of the returning flight in YYYY-MM-DD format")
+    ],
+    date_window: Annotated[
+        int, Query(description="also search this many days around each date", ge=0, le=3)
+    ] = 0,
+    radius: Annotated[
+        float | None,
+        Query(description="also search airports within this many km", gt=0, le=500),
+    ] = None,
+    max_upstream: Annotated[
+        int, Query(description="most searches to make upstream", ge=0, le=20)
+    ] = 6,
+    dry_run: Annotated[
+        bool, Query(description="only plan the searches, don't make them")
+    ] = False,
+    limit: Annotated[int, Query(description="max flights", ge=1, le=100)] = 20,
+    num_adults: Annotated[int, Query(description="number of adults")] = 1,
+    wait_time: Annotated[
+        int, Query(description="max wait time in milliseconds", ge=0, le=5000)
+    ] = 500,
+) -> FlexibleSearchResponse:
+    """
+    Searches around the given airports and dates and ranks everything found by
+    layover hours. Searches that are already cached are free; the rest are
+    made upstream, up to max_upstream and what the monthly budget allows.
+    Details of a flight come from /api/flights with its airports and dates.
+    """
+    validate_iata(origin, dest)
+
+    if date > return_date:
+        raise HTTPException(status_code=400, detail="Invalid dates")
+
+    queries = fanout.plan(
+        origin,
+        dest,
+        date,
+        return_date,
+        date_window,
+        radius,
+        fanout.upstream_allowance(max_upstream),
+    )
 
-    details_pop = [detail for detail in details if detail is not None]
-    set_popularity_for_flights(details_pop)
+    upstream_calls = 0
+    if not dry_run:
+        upstream_calls = await fanout.run(queries, num_adults, wait_time, user.id)
 
-    return details_pop
+    return FlexibleSearchResponse(
+        flights=fanout.merge(queries, limit) if not dry_run else [],
+        queries=queries,
+        upstream_calls=upstream_calls,
+        cached_queries=sum(q.source == "cache" for q in queries),
+    )
+
+
+@app.post("/api/flights/sessions")
+async def start_search_session(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    origin: Annotated[str, Query(description="3-letter airport code (IATA)")],
+    dest: Annotated[str, Query(description="3-letter airport code (IATA)")],
+    date: Annotated[
+        Date, Query(description="date of first flight in YYYY-MM-DD format")
+    ],
+    return_date: Annotated[
+        Date, Query(description="date of the returning flight in YYYY-MM-DD format")
+    ],
+    num_adults: Annotated[int, Query(description="number of adults")] = 1,
+) -> SearchSession:
+    """
+    Starts a search that returns a first batch of results quickly and keeps
+    looking for more in the background. Pages are read from /api/flights with
+    the same parameters and change as the session's version goes up; follow
+    it with /api/flights/sessions/{id} or its /events stream.
+    """
+    validate_iata(origin, dest)
+
+    if date > return_date:
+        raise HTTPException(status_code=400, detail="Invalid dates")
+
+    if budget.state().mode == "cache_only":
+        raise HTTPException(
+            status_code=503,
+            detail="Flight search is limited to cached results for the rest of the month",
+        )
+
+    try:
+        session = await sessions.start(
+            origin, dest, date, return_date, num_adults, user.id
+        )
+    except HTTPException as e:
+        raise e
+    except limiter.LimitedException as e:
+        limiter.raise_http(e)
+    except Exception as e:
+        httputil.raise_external(e)
+
+    return session.state()
+
+
+def __get_search_session(id: str) -> sessions.Session:
+    session = sessions.get(id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Search session not found")
+    return session
+
+
+@app.get("/api/flights/sessions/{id}")
+async def get_search_session(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    session: Annotated[sessions.Session, Depends(__get_search_session)],
+    version: Annotated[
+        int | None,
+        Query(description="wait for a version newer than this one, up to 30s"),
+    ] = None,
+) -> SearchSession:
+    if version is None:
+        return session.state()
+
+    try:
+        return await asyncio.wait_for(session.wait(version), 30)
+    except asyncio.TimeoutError:
+        return session.state()
+
+
+@app.get("/api/flights/sessions/{id}/events")
+async def stream_search_session(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    session: Annotated[sessions.Session, Depends(__get_search_session)],
+) -> StreamingResponse:
+    """
+    Streams the session as newline-delimited JSON, one line every time its
+    results change, until it's complete.
+    """
+
+    async def events():
+        state = session.state()
+        yield state.json().encode() + b"\n"
+        while not state.complete:
+            state = await session.wait(state.version)
+            yield state.json().encode() + b"\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 
 @app.get("/api/layovers")
@@ -343,6 +839,14 @@ def layovers(
     return LayoversResponse(layovers=layovers)
 
 
+def layover_in_utc(layover: AddOrRemoveLayoverRequest) -> AddOrRemoveLayoverRequest:
+    # Layovers are stored in UTC, so that they compare as strings the same way
+    # they do as times whatever offset they were sent with.
+    return layover.copy(
+        update={"arrive": in_utc(layover.arrive), "depart": in_utc(layover.depart)}
+    )
+
+
 @app.post("/api/layovers", status_code=204)
 def add_layover(
     user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
@@ -352,8 +856,14 @@ def add_layover(
     Mark a layover flight as interested. This contributes towards a popularity
     score for each airport.
     """
+    body = layover_in_utc(body)
     if get_airport_by_iata(body.iata) is None:
         raise HTTPException(status_code=404, detail="Airport not found")
+    if body.depart - body.arrive > MAX_LAYOVER:
+        raise HTTPException(
+            status_code=400,
+            detail=f"layovers can be at most {MAX_LAYOVER.days} days long",
+        )
 
     try:
         cur = db.cursor()
@@ -365,6 +875,7 @@ def add_layover(
             (body.iata, body.depart, body.arrive, user.id),
         )
         db.commit()
+        popularity_changed([body.iata])
     except HTTPException as e:
         raise e
     except IntegrityError as e:
@@ -375,6 +886,8 @@ def add_layover(
     except Exception as e:
         httputil.raise_external(e)
 
+    notify.layover_changed(user.id, body.iata, body.arrive, body.depart, True)
+
 
 @app.delete("/api/layovers", status_code=204)
 def remove_layover(
@@ -384,6 +897,7 @@ def remove_layover(
     """
     Unmark a layover flight as interested. This undoes add_layover.
     """
+    body = layover_in_utc(body)
     cur = db.cursor()
     cur.execute(
         """
@@ -393,37 +907,403 @@ def remove_layover(
         (body.iata, body.depart, body.arrive, user.id),
     )
     db.commit()
+    popularity_changed([body.iata])
+
+    if cur.rowcount > 0:
+        notify.layover_changed(user.id, body.iata, body.arrive, body.depart, False)
+
+
+@app.websocket("/api/layovers/notifications")
+async def layover_notifications(
+    websocket: WebSocket,
+    token: Annotated[
+        str | None,
+        Query(description="session token, for clients that can't set headers"),
+    ] = None,
+):
+    """
+    Sends an event whenever someone adds or removes a layover that overlaps
+    one of yours, instead of having to poll /api/layovers/matches. Events are
+    JSON: {"type": "match" or "unmatch", "match": LayoverMatch}, or
+    {"type": "resync"} if events were dropped because the connection fell
+    behind, after which matches should be fetched again.
+    """
+    if token is None:
+        scheme, _, token = websocket.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            token = None
+
+    user = get_user_by_token(token) if token else None
+    if user is None:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscription = notify.subscribe(user.id)
+
+    async def send():
+        async for event in subscription.events():
+            await asyncio.wait_for(websocket.send_text(event), notify.SEND_TIMEOUT)
+
+    async def receive():
+        # Nothing is expected from clients; this is only to notice them leave.
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    sender = asyncio.ensure_future(send())
+    receiver = asyncio.ensure_future(receive())
+    try:
+        await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        replaced = subscription.closed
+        notify.unsubscribe(subscription)
+        for task in (sender, receiver):
+            task.cancel()
+
+    if receiver.done():
+        return
+
+    # Closed for a newer connection from the same user, or a send failed or
+    # took too long.
+    try:
+        await websocket.close(code=1000 if replaced else 1011)
+    except Exception:
+        pass
+
+
+# Most layovers /api/layovers/batch takes in each of add and remove.
+MAX_LAYOVER_BATCH = 100
+
+
+@app.post("/api/layovers/batch")
+def batch_layovers(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    body: LayoverBatchRequest,
+) -> LayoverBatchResponse:
+    """
+    Mark and unmark many layover flights at once, e.g. every stop of a trip.
+    Everything is added, then removed, in one transaction, and each layover
+    gets its own result instead of failing the whole batch.
+    """
+    if len(body.add) > MAX_LAYOVER_BATCH or len(body.remove) > MAX_LAYOVER_BATCH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"at most {MAX_LAYOVER_BATCH} layovers each to add and remove",
+        )
+
+    add = [layover_in_utc(l) for l in body.add]
+    remove = [layover_in_utc(l) for l in body.remove]
+
+    def key(layover: AddOrRemoveLayoverRequest) -> tuple[str, str, str]:
+        # As stored: sqlite3 stores datetimes as str() of them.
+        return (layover.iata, str(layover.arrive), str(layover.depart))
+
+    to_add = [
+        layover
+        for layover in {key(l): l for l in add}.values()
+        if get_airport_by_iata(layover.iata) is not None
+        and layover.depart - layover.arrive <= MAX_LAYOVER
+    ]
+    to_remove = list({key(l): l for l in remove}.values())
+
+    cur = db.cursor()
+    try:
+        # One statement each, so that both are all or nothing.
+        added = set()
+        if to_add:
+            rows = cur.execute(
+                f"""
+                INSERT INTO layovers (iata_code, arrive, depart, user_id)
+                VALUES {', '.join(['(?, ?, ?, ?)'] * len(to_add))}
+                ON CONFLICT DO NOTHING
+                RETURNING iata_code, arrive, depart
+                """,
+                [v for l in to_add for v in (l.iata, l.arrive, l.depart, user.id)],
+            ).fetchall()
+            added = {tuple(row) for row in rows}
+
+        removed = set()
+        if to_remove:
+            rows = cur.execute(
+                f"""
+                DELETE FROM layovers
+                WHERE user_id = ? AND (iata_code, arrive, depart) IN (
+                    VALUES {', '.join(['(?, ?, ?)'] * len(to_remove))}
+                )
+                RETURNING iata_code, arrive, depart
+                """,
+                [user.id, *(v for l in to_remove for v in (l.iata, l.arrive, l.depart))],
+            ).fetchall()
+            removed = {tuple(row) for row in rows}
+
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        httputil.raise_external(e)
+
+    popularity_changed({k[0] for k in added | removed})
+
+    for layover in to_add:
+        if key(layover) in added:
+            notify.layover_changed(
+                user.id, layover.iata, layover.arrive, layover.depart, True
+            )
+    for layover in to_remove:
+        if key(layover) in removed:
+            notify.layover_changed(
+                user.id, layover.iata, layover.arrive, layover.depart, False
+            )
+
+    def results(
+        layovers: list[AddOrRemoveLayoverRequest],
+        done: set[tuple[str, str, str]],
+        status: str,
+        otherwise: str,
+        adding: bool,
+    ) -> list[LayoverBatchResult]:
+        # Repeats of the same layover in a batch only count once.
+        done = set(done)
+        out = []
+        for layover in layovers:
+            # Check what was done first: a layover can still be removed after
+            # its airport is gone from the registry.
+            if key(layover) in done:
+                result = status
+                done.remove(key(layover))
+            elif get_airport_by_iata(layover.iata) is None:
+                result = "unknown_airport"
+            elif adding and layover.depart - layover.arrive > MAX_LAYOVER:
+                result = "too_long"
+            else:
+                result = otherwise
+            out.append(LayoverBatchResult(**layover.dict(), status=result))
+        return out
+
+    return LayoverBatchResponse(
+        add=results(add, added, "added", "exists", True),
+        remove=results(remove, removed, "removed", "missing", False),
+    )
+
+
+@app.get("/api/layovers/matches")
+def get_layover_matches(
+    user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
+    response: Response,
+    limit: Annotated[int, Query(description="most matches per page", ge=1, le=200)] = 50,
+    cursor: Annotated[
+        str | None,
+        Query(description="X-Next-Cursor of the previous page"),
+    ] = None,
+) -> list[LayoverMatch]:
+    """
+    Get the other users whose layovers overlap any of yours, for all of your
+    layovers at once, ordered by your layover.
+    """
+    after = None
+    if cursor is not None:
+        try:
+            after = MatchCursor.decode(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    matches, next = find_matches(user.id, limit=limit, after=after)
+    if next is not None:
+        response.headers["X-Next-Cursor"] = next.encode()
+
+    return matches
 
 
 @app.get("/api/layovers/{iata_code}")
 def get_layovers_for_airport(
     user: Annotated[AuthorizedUser, Depends(get_authorized_user)],
     iata_code: str,
+    response: Response,
+    limit: Annotated[int, Query(description="most matches per page", ge=1, le=200)] = 50,
+    cursor: Annotated[
+        str | None,
+        Query(description="X-Next-Cursor of the previous page"),
+    ] = None,
 ) -> list[UserResponse]:
+    """
+    Get the other users whose layovers at the airport overlap yours. Someone
+    whose layovers overlap more than one of yours may show up on more than one
+    page.
+    """
     if get_airport_by_iata(iata_code) is None:
         raise HTTPException(status_code=404, detail="Airport not found")
 
-    return get_users_in_layover(user.id, iata_code)
+    after = None
+    if cursor is not None:
+        try:
+            after = MatchCursor.decode(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    users, next = get_users_in_layover(user.id, iata_code, limit, after)
+    if next is not None:
+        response.headers["X-Next-Cursor"] = next.encode()
+
+    return users
 
 
 @app.get("/api/airports")
 def airports(
     name: Annotated[
         str | None, Query(description="airport name (must not have lat or long)")
-    ],
-    lat: Annotated[float | None, Query(description="latitude (must also have long)")],
-    long: Annotated[float | None, Query(description="longitude (must also have lat)")],
+    ] = None,
+    lat: Annotated[
+        float | None, Query(description="latitude (must also have long)")
+    ] = None,
+    long: Annotated[
+        float | None, Query(description="longitude (must also have lat)")
+    ] = None,
+    radius: Annotated[
+        float | None,
+        Query(description="only airports within this many kilometers", gt=0),
+    ] = None,
 ) -> ListAirportsResponse:
     if name:
-        airports = find_airports_by_name(name)
-    elif lat and long:
-        airports = find_airports_by_coords(lat, long)
+        airports = [
+            ListAirportsResponse.Airport(**airport.dict())
+            for airport in find_airports_by_name(name)
+        ]
+    elif lat is not None and long is not None:
+        airports = [
+            ListAirportsResponse.Airport(**airport.dict(), distance=distance)
+            for airport, distance in find_airports_by_coords(lat, long, radius=radius)
+        ]
     else:
         raise HTTPException(status_code=400, detail="need either ?name or ?lat&long")
 
+    popularity = get_popularity(airport.iata for airport in airports)
+    airports = [
+        airport.copy(update={"popularity": popularity.get(airport.iata, 0)})
+        for airport in airports
+    ]
+
     return ListAirportsResponse(airports=airports)
 
 
+# Longest time range /api/airports/occupancy can be asked for, and most
+# airports it can be asked for by code.
+MAX_OCCUPANCY_HOURS = 31 * 24
+MAX_OCCUPANCY_AIRPORTS = 100
+
+
+@app.get("/api/airports/occupancy")
+def airport_occupancy(
+    iata: Annotated[
+        list[str] | None,
+        Query(description="airport codes (IATA), repeated for each airport"),
+    ] = None,
+    bbox: Annotated[
+        str | None,
+        Query(description="min_lat,min_long,max_lat,max_long instead of iata"),
+    ] = None,
+    start: Annotated[
+        datetime | None, Query(description="start of the range, default now")
+    ] = None,
+    end: Annotated[
+        datetime | None, Query(description="end of the range, default 2 weeks on")
+    ] = None,
+    limit: Annotated[
+        int, Query(description="most airports in bbox, busiest first", ge=1, le=100)
+    ] = 20,
+) -> OccupancyResponse:
+    """
+    Get how many layovers are on at each airport during each hour of a time
+    range, for the given airports or the busiest ones in a box. This reads
+    hourly counts kept up to date as layovers are added and removed, so it
+    costs the same no matter how many layovers there are.
+    """
+    first = hour_of(start or datetime.utcnow())
+    stop = first + 14 * 24
+    if end is not None:
+        # Up to and including the hour end is in, unless it's right on it.
+        stop = hour_of(end - timedelta(microseconds=1)) + 1
+    hours = stop - first
+    if hours < 1:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if hours > MAX_OCCUPANCY_HOURS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"range must be at most {MAX_OCCUPANCY_HOURS} hours",
+        )
+
+    if (iata is None) == (bbox is None):
+        raise HTTPException(status_code=400, detail="need either ?iata or ?bbox")
+
+    if iata is not None:
+        codes = list(dict.fromkeys(iata))
+        if len(codes) > MAX_OCCUPANCY_AIRPORTS:
+            raise HTTPException(
+                status_code=400, detail=f"at most {MAX_OCCUPANCY_AIRPORTS} airports"
+            )
+        airports = []
+        for code in codes:
+            airport = get_airport_by_iata(code)
+            if airport is None:
+                raise HTTPException(status_code=404, detail=f"Airport {code} not found")
+            airports.append(airport)
+    else:
+        try:
+            min_lat, min_long, max_lat, max_long = map(float, bbox.split(","))
+        except ValueError:
+            raise HTTPException(
+                status_code=400, detail="bbox must be min_lat,min_long,max_lat,max_long"
+            )
+        # Airports nobody has ever had a layover at can't be busy.
+        airports = find_airports_in_box(min_lat, min_long, max_lat, max_long)
+        popularity = get_popularity(a.iata for a in airports)
+        airports = [a for a in airports if a.iata in popularity]
+
+    occupancy = get_occupancy((a.iata for a in airports), first, stop)
+
+    results = []
+    for airport in airports:
+        counts = occupancy.get(airport.iata, {})
+        present = [counts.get(h, 0) for h in range(first, stop)]
+        results.append(
+            AirportOccupancy(airport=airport, present=present, peak=max(present))
+        )
+
+    if bbox is not None:
+        results = [r for r in results if r.peak > 0]
+        results.sort(key=lambda r: sum(r.present), reverse=True)
+        results = results[:limit]
+
+    return OccupancyResponse(
+        start=datetime.fromtimestamp(first * 3600, timezone.utc),
+        hours=hours,
+        airports=results,
+    )
+
+
+@app.get("/api/admin/metrics")
+def metrics(
+    admin: Annotated[AuthorizedUser, Depends(get_admin_user)],
+) -> MetricsResponse:
+    return MetricsResponse(
+        coalescing={
+            "searches": flight_searches.stats(),
+            "details": flight_details.stats(),
+        },
+        cache=httputil.stats(),
+        prefetch=prefetch.stats(),
+        upstream=upstream.stats(),
+        notifications=notify.stats(),
+    )
+
+
+@app.get("/api/admin/budget")
+def get_budget(
+    admin: Annotated[AuthorizedUser, Depends(get_admin_user)],
+) -> BudgetState:
+    return budget.state()
+
+
 @app.get("/api/assets/{hash}/{filename}")
 def get_asset(hash: str, filename: str) -> Response:
     cur = db.cursor()
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import date as Date, datetime
 from pydantic import BaseModel
 
 
@@ -50,11 +50,32 @@ class Airport(BaseModel):
     lat: float
     long: float
 
+    class Config:
+        # Airports are shared by the in-memory registry, so they must never be
+        # mutated by whoever looks them up.
+        frozen = True
+
 
 class ListAirportsResponse(BaseModel):
+    class Airport(Airport):
+        distance: float | None  # km, only set when searching by coordinates
+        popularity: int = 0  # layovers people have marked here
+
     airports: list[Airport]
 
 
+class AirportOccupancy(BaseModel):
+    airport: Airport
+    present: list[int]  # layovers on during each hour, from start
+    peak: int
+
+
+class OccupancyResponse(BaseModel):
+    start: datetime  # first hour, in UTC
+    hours: int
+    airports: list[AirportOccupancy]
+
+
 class Carrier(BaseModel):
     id: int | None
     name: str | None
@@ -177,6 +198,17 @@ class LayoverDb(BaseModel):
     iata_code: str
 
 
+class LayoverMatch(BaseModel):
+    # iata, arrive and depart are your layover; user_arrive and user_depart
+    # are theirs.
+    iata: str
+    arrive: datetime
+    depart: datetime
+    user: UserResponse
+    user_arrive: datetime
+    user_depart: datetime
+
+
 class FlightDetailResponse(BaseModel):
     status: bool | None
     message: str | object | None
@@ -190,6 +222,26 @@ class AddOrRemoveLayoverRequest(BaseModel):
     arrive: datetime
 
 
+class LayoverBatchRequest(BaseModel):
+    add: list[AddOrRemoveLayoverRequest] = []
+    remove: list[AddOrRemoveLayoverRequest] = []
+
+
+class LayoverBatchResult(BaseModel):
+    iata: str
+    arrive: datetime
+    depart: datetime
+    # "added", "removed", "exists" if it was already added, "missing" if there
+    # was nothing to remove, "unknown_airport", or "too_long" if it was to be
+    # added and is longer than layovers.MAX_LAYOVER.
+    status: str
+
+
+class LayoverBatchResponse(BaseModel):
+    add: list[LayoverBatchResult]
+    remove: list[LayoverBatchResult]
+
+
 class LayoversResponse(BaseModel):
     class Layover(BaseModel):
         iata: str
@@ -204,6 +256,127 @@ class AssetUploadResponse(BaseModel):
     path: str
 
 
+class CoalescingStats(BaseModel):
+    upstream_calls: int  # calls that actually went upstream
+    coalesced_calls: int  # calls that waited on another identical call instead
+    in_flight: int
+
+
+class BudgetState(BaseModel):
+    month: str  # YYYY-MM, in UTC
+    budget: int
+    spent: int
+    remaining: int
+    days_left: float
+    projected: int  # spend by the end of the month at the current run rate
+    daily_allowance: float  # what we can spend per day for the rest of the month
+    pace: float  # spend relative to an even pace through the month
+    mode: str  # "normal", "conserve" or "cache_only"
+    detail_fanout: float  # fraction of uncached flight details to fetch
+    by_endpoint: dict[str, int]
+    top_users: dict[str, int]
+
+
+class CacheStats(BaseModel):
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    memory_evictions: int
+    disk_evictions: int
+    expired: int
+    memory_entries: int
+    memory_bytes: int
+
+
+class SearchSession(BaseModel):
+    id: str
+    origin: str
+    dest: str
+    date: Date
+    return_date: Date
+    version: int  # goes up every time the results change
+    count: int  # itineraries found so far
+    polls: int  # upstream searches made
+    complete: bool  # whether the results are final
+    error: str | None
+
+
+class FlexibleQuery(BaseModel):
+    origin: str
+    dest: str
+    date: Date
+    return_date: Date
+    # Where the results came from: "cache", "upstream", "coalesced" (someone
+    # else's upstream search), or "skipped" or "failed" for no results. Only
+    # failed searches this request made itself count as upstream_calls.
+    source: str
+    count: int | None  # itineraries taken from this search
+    error: str | None
+
+
+class FlexibleFlight(BaseModel):
+    itinerary_id: str
+    origin: str
+    dest: str
+    date: Date
+    return_date: Date
+    layover_hours: float | None
+    price: float | None
+
+
+class FlexibleSearchResponse(BaseModel):
+    flights: list[FlexibleFlight]
+    queries: list[FlexibleQuery]
+    upstream_calls: int  # searches this request charged to the monthly budget
+    cached_queries: int
+
+
+class PrefetchStats(BaseModel):
+    prefetched: int  # details fetched ahead of time
+    hits: int  # of those, how many a later page then asked for
+    hit_rate: float
+    cancelled: int  # prefetches stopped because the user moved on
+    running: int
+
+
+class LatencyStats(BaseModel):
+    count: int
+    p50: float  # ms
+    p95: float
+    p99: float
+
+
+class UpstreamStats(BaseModel):
+    requests: int  # sent, including retries and hedges
+    retries: int
+    hedged: int  # calls that were slow enough to send a second request
+    hedge_wins: int  # of those, how many the second request answered first
+    errors: int  # calls that still failed after retrying
+    rejected: int  # calls failed right away by the circuit breaker
+    in_flight: int
+    breaker: str  # "closed", "open" or "half_open"
+    breaker_opens: int
+    pool_limit: int
+    pool_in_use: int
+    latency: dict[str, LatencyStats]  # by endpoint
+
+
+class NotificationStats(BaseModel):
+    connections: int
+    users: int
+    sent: int
+    resyncs: int  # times a connection fell too far behind and lost events
+    evicted: int  # connections closed for a newer one from the same user
+
+
+class MetricsResponse(BaseModel):
+    coalescing: dict[str, CoalescingStats]
+    cache: CacheStats
+    prefetch: PrefetchStats
+    upstream: UpstreamStats
+    notifications: NotificationStats
+
+
 if __name__ == "__main__":
     with open("data/flight_response_example.json") as f:
         js = f.read()
@@ -222,10 +395,10 @@ if __name__ == "__main__":
     fdr = FlightDetailResponse.parse_raw(js)
 
     assert fdr.data is not None
-    assert fdr.data[0].legs is not None
-    assert fdr.data[0].legs[0].segments is not None
-    assert len(fdr.data[0].legs[0].segments) > 0
-    assert fdr.data[0].legs[0].layovers is not None
-    assert len(fdr.data[0].legs[0].layovers) > 0
+    assert fdr.data.legs is not None
+    assert fdr.data.legs[0].segments is not None
+    assert len(fdr.data.legs[0].segments) > 0
+    assert fdr.data.legs[0].layovers is not None
+    assert len(fdr.data.legs[0].layovers) > 0
 
     print("Bueno ✊🍆💦")
@@ -0,0 +1,174 @@
+import json
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import AsyncIterator
+
+from db import db
+from layovers import find_overlapping
+from models import LayoverMatch, NotificationStats, UserResponse
+
+# Connections one user can have open at once. Opening another closes their
+# oldest one, which is most likely one their client has already given up on.
+MAX_CONNECTIONS = 3
+
+# Events a connection can fall behind by. Past that, its events are dropped
+# and it's told to resync from /api/layovers/matches instead, so that a slow
+# client never holds up anyone else or grows without bound.
+QUEUE_SIZE = 100
+
+# Sends that take longer than this close the connection.
+SEND_TIMEOUT = 10  # seconds
+
+
+class Subscription:
+    """
+    One open connection's queue of events to send.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: deque[str] = deque()
+        self.lagged = False
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def put(self, event: str):
+        # Must be called on self.loop.
+        if self.closed or self.lagged:
+            return
+        if len(self.queue) >= QUEUE_SIZE:
+            self.queue.clear()
+            self.lagged = True
+        else:
+            self.queue.append(event)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def events(self) -> AsyncIterator[str]:
+        """
+        Yields events as JSON until the subscription is closed.
+        """
+        global sent, resyncs
+
+        while not self.closed:
+            await self.ready.wait()
+            self.ready.clear()
+
+            if self.lagged:
+                self.lagged = False
+                resyncs += 1
+                yield json.dumps({"type": "resync"})
+
+            while self.queue and not self.closed:
+                sent += 1
+                yield self.queue.popleft()
+
+
+# Open subscriptions by user, oldest first. Only changed on the event loop.
+subscriptions: dict[str, list[Subscription]] = {}
+
+sent = 0
+resyncs = 0
+evicted = 0
+
+
+def subscribe(user_id: str) -> Subscription:
+    """
+    Subscribes a new connection to the user's events, closing their oldest
+    one if they have too many.
+    """
+    global evicted
+
+    subscription = Subscription(user_id)
+    subs = subscriptions.setdefault(user_id, [])
+    subs.append(subscription)
+
+    while len(subs) > MAX_CONNECTIONS:
+        subs.pop(0).close()
+        evicted += 1
+
+    return subscription
+
+
+def unsubscribe(subscription: Subscription):
+    subscription.close()
+
+    subs = subscriptions.get(subscription.user_id, [])
+    if subscription in subs:
+        subs.remove(subscription)
+    if not subs:
+        subscriptions.pop(subscription.user_id, None)
+
+
+def publish(user_id: str, event: str):
+    """
+    Queues an event for every connection of the user. Can be called from any
+    thread.
+    """
+    for subscription in list(subscriptions.get(user_id, ())):
+        subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+
+def layover_changed(
+    user_id: str,
+    iata_code: str,
+    arrive: datetime,
+    depart: datetime,
+    added: bool,
+):
+    """
+    Tells the subscribed users whose layovers overlap the user's layover that
+    it was added or removed. Call after committing the change.
+    """
+    if not subscriptions:
+        return
+
+    # The same lookup as the other users' matches would make, but once for
+    # everyone it affects.
+    overlapping = [
+        match
+        for match in find_overlapping(user_id, iata_code, arrive, depart)
+        if match.user.id in subscriptions
+    ]
+    if not overlapping:
+        return
+
+    row = db.execute(
+        "SELECT id, email, first_name, profile_picture FROM users WHERE id = ?",
+        (user_id,),
+    ).fetchone()
+    if row is None:
+        return
+    user = UserResponse(**row)
+
+    for match in overlapping:
+        theirs = LayoverMatch(
+            iata=iata_code,
+            arrive=match.user_arrive,
+            depart=match.user_depart,
+            user=user,
+            user_arrive=arrive,
+            user_depart=depart,
+        )
+        event = json.dumps(
+            {
+                "type": "match" if added else "unmatch",
+                "match": json.loads(theirs.json()),
+            }
+        )
+        publish(match.user.id, event)
+
+
+def stats() -> NotificationStats:
+    return NotificationStats(
+        connections=sum(len(subs) for subs in subscriptions.values()),
+        users=len(subscriptions),
+        sent=sent,
+        resyncs=resyncs,
+        evicted=evicted,
+    )
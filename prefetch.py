@@ -0,0 +1,116 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import budget
+import httputil
+import limiter
+from flights import fetch_details_user_limiter
+from models import PrefetchStats
+
+# How long after serving a page to wait before prefetching the next one, so
+# that prefetches don't compete with whatever the client does right after.
+DELAY = 1.0
+
+# Prefetching stops while the user has less than this fraction of their
+# flight details rate limit left, which is kept for pages they actually ask
+# for.
+RESERVE = 0.5
+
+# How many prefetched details to remember when counting hits.
+TRACKED = 10000
+
+# At most one prefetch runs per user: the one for the page after the last
+# page they asked for.
+tasks: dict[str, asyncio.Task] = {}
+
+# Prefetched details nobody has asked for yet, by cache key digest.
+pending: OrderedDict[bytes, None] = OrderedDict()
+
+prefetched = 0
+hits = 0
+cancelled = 0
+
+
+def start(user_id: str, fn: Callable[[], Awaitable[None]]):
+    """
+    Starts prefetching for the user in the background, replacing any prefetch
+    they already have running.
+    """
+    cancel(user_id)
+
+    async def run():
+        await asyncio.sleep(DELAY)
+        try:
+            await fn()
+        except Exception as e:
+            # Prefetching is best effort; the page will fetch it if needed.
+            print(f"prefetch failed: {e!r}")
+
+    def done(task: asyncio.Task):
+        if tasks.get(user_id) is task:
+            del tasks[user_id]
+
+    task = asyncio.ensure_future(run())
+    task.add_done_callback(done)
+    tasks[user_id] = task
+
+
+def cancel(user_id: str):
+    """
+    Stops the user's prefetch, e.g. because they asked for something else.
+    Detail fetches it already started still finish and get cached, since other
+    requests may be waiting on them too.
+    """
+    global cancelled
+
+    task = tasks.pop(user_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+        cancelled += 1
+
+
+def allowed(user_id: str) -> bool:
+    """
+    Reports whether the user's prefetch may make another upstream call.
+    """
+    if budget.state().mode != "normal":
+        return False
+
+    limit = fetch_details_user_limiter._rates[-1].limit
+    return limiter.available(fetch_details_user_limiter, user_id) > limit * RESERVE
+
+
+def track(key: dict):
+    """
+    Records that the detail with the given cache key is being prefetched.
+    """
+    global prefetched
+
+    prefetched += 1
+    pending[httputil.digest(key)] = None
+    while len(pending) > TRACKED:
+        pending.popitem(last=False)
+
+
+def used(key: dict):
+    """
+    Records that a page asked for the detail with the given cache key, which
+    is a hit if it was prefetched.
+    """
+    global hits
+
+    keyhash = httputil.digest(key)
+    if keyhash in pending:
+        del pending[keyhash]
+        hits += 1
+
+
+def stats() -> PrefetchStats:
+    return PrefetchStats(
+        prefetched=prefetched,
+        hits=hits,
+        hit_rate=hits / prefetched if prefetched else 0.0,
+        cancelled=cancelled,
+        running=len(tasks),
+    )
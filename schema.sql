@@ -28,6 +28,145 @@ CREATE TABLE IF NOT EXISTS layovers (
 CREATE UNIQUE INDEX IF NOT EXISTS layovers_unique_idx
 	ON layovers(user_id, iata_code, arrive, depart);
 
+-- For finding overlapping layovers at an airport. Ordered by depart first so
+-- that lookups skip layovers that are already over, and stop at the ones that
+-- leave too late to have started in time (see layovers.MAX_LAYOVER).
+CREATE INDEX IF NOT EXISTS layovers_overlap_idx
+	ON layovers(iata_code, depart, arrive, user_id);
+
+-- Layovers per airport, kept up to date by the triggers below so that
+-- popularity never has to count the layovers table.
+CREATE TABLE IF NOT EXISTS airport_popularity (
+	iata_code TEXT PRIMARY KEY,
+	layovers INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Fill it in from existing layovers the first time around.
+INSERT INTO airport_popularity (iata_code, layovers)
+	SELECT iata_code, COUNT(*) FROM layovers
+	WHERE NOT EXISTS (SELECT 1 FROM airport_popularity)
+	GROUP BY iata_code;
+
+CREATE TRIGGER IF NOT EXISTS layovers_popularity_insert
+	AFTER INSERT ON layovers
+BEGIN
+	INSERT INTO airport_popularity (iata_code, layovers) VALUES (NEW.iata_code, 1)
+		ON CONFLICT (iata_code) DO UPDATE SET layovers = layovers + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS layovers_popularity_delete
+	AFTER DELETE ON layovers
+BEGIN
+	UPDATE airport_popularity SET layovers = layovers - 1
+		WHERE iata_code = OLD.iata_code;
+END;
+
+CREATE TRIGGER IF NOT EXISTS layovers_popularity_update
+	AFTER UPDATE OF iata_code ON layovers
+	WHEN NEW.iata_code != OLD.iata_code
+BEGIN
+	UPDATE airport_popularity SET layovers = layovers - 1
+		WHERE iata_code = OLD.iata_code;
+	INSERT INTO airport_popularity (iata_code, layovers) VALUES (NEW.iata_code, 1)
+		ON CONFLICT (iata_code) DO UPDATE SET layovers = layovers + 1;
+END;
+
+-- People at each airport by hour, in hours since the Unix epoch: how many
+-- layovers start in that hour, and how many are on for any part of it. Kept
+-- up to date by the triggers below so that popularity over time never has to
+-- read individual layovers.
+CREATE TABLE IF NOT EXISTS airport_hours (
+	iata_code TEXT NOT NULL,
+	hour INTEGER NOT NULL,
+	arrivals INTEGER NOT NULL,
+	present INTEGER NOT NULL,
+	PRIMARY KEY (iata_code, hour)
+) WITHOUT ROWID;
+
+-- 0 to 30 days in hours, for spreading a layover over the hours it covers
+-- (triggers can't use recursive CTEs). Only the first 30 days of longer
+-- layovers are counted as present.
+CREATE TABLE IF NOT EXISTS hour_offsets (n INTEGER PRIMARY KEY);
+
+INSERT OR IGNORE INTO hour_offsets (n)
+	WITH RECURSIVE hours(n) AS (
+		SELECT 0 UNION ALL SELECT n + 1 FROM hours WHERE n + 1 < 30 * 24
+	)
+	SELECT n FROM hours;
+
+INSERT INTO airport_hours (iata_code, hour, arrivals, present)
+	SELECT iata_code, hour, SUM(arrivals), SUM(present) FROM (
+		SELECT iata_code, strftime('%s', arrive) / 3600 AS hour, 1 AS arrivals, 0 AS present
+		FROM layovers
+		UNION ALL
+		SELECT iata_code, strftime('%s', arrive) / 3600 + n, 0, 1
+		FROM layovers JOIN hour_offsets
+			ON n < (strftime('%s', depart) + 3599) / 3600 - strftime('%s', arrive) / 3600
+	)
+	WHERE NOT EXISTS (SELECT 1 FROM airport_hours)
+	GROUP BY iata_code, hour;
+
+CREATE TRIGGER IF NOT EXISTS layovers_hours_insert
+	AFTER INSERT ON layovers
+BEGIN
+	INSERT INTO airport_hours (iata_code, hour, arrivals, present)
+		VALUES (NEW.iata_code, strftime('%s', NEW.arrive) / 3600, 1, 0)
+		ON CONFLICT (iata_code, hour) DO UPDATE SET arrivals = arrivals + 1;
+	INSERT INTO airport_hours (iata_code, hour, arrivals, present)
+		SELECT NEW.iata_code, strftime('%s', NEW.arrive) / 3600 + n, 0, 1
+		FROM hour_offsets
+		WHERE n < (strftime('%s', NEW.depart) + 3599) / 3600 - strftime('%s', NEW.arrive) / 3600
+		ON CONFLICT (iata_code, hour) DO UPDATE SET present = present + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS layovers_hours_delete
+	AFTER DELETE ON layovers
+BEGIN
+	UPDATE airport_hours SET arrivals = arrivals - 1
+		WHERE iata_code = OLD.iata_code AND hour = strftime('%s', OLD.arrive) / 3600;
+	UPDATE airport_hours SET present = present - 1
+		WHERE iata_code = OLD.iata_code
+		AND hour >= strftime('%s', OLD.arrive) / 3600
+		AND hour < (strftime('%s', OLD.depart) + 3599) / 3600
+		AND hour < strftime('%s', OLD.arrive) / 3600 + 30 * 24;
+	DELETE FROM airport_hours
+		WHERE iata_code = OLD.iata_code
+		AND hour >= strftime('%s', OLD.arrive) / 3600
+		AND hour < MAX(
+			strftime('%s', OLD.arrive) / 3600 + 1,
+			(strftime('%s', OLD.depart) + 3599) / 3600
+		)
+		AND arrivals = 0 AND present = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS layovers_hours_update
+	AFTER UPDATE OF iata_code, arrive, depart ON layovers
+BEGIN
+	UPDATE airport_hours SET arrivals = arrivals - 1
+		WHERE iata_code = OLD.iata_code AND hour = strftime('%s', OLD.arrive) / 3600;
+	UPDATE airport_hours SET present = present - 1
+		WHERE iata_code = OLD.iata_code
+		AND hour >= strftime('%s', OLD.arrive) / 3600
+		AND hour < (strftime('%s', OLD.depart) + 3599) / 3600
+		AND hour < strftime('%s', OLD.arrive) / 3600 + 30 * 24;
+	DELETE FROM airport_hours
+		WHERE iata_code = OLD.iata_code
+		AND hour >= strftime('%s', OLD.arrive) / 3600
+		AND hour < MAX(
+			strftime('%s', OLD.arrive) / 3600 + 1,
+			(strftime('%s', OLD.depart) + 3599) / 3600
+		)
+		AND arrivals = 0 AND present = 0;
+	INSERT INTO airport_hours (iata_code, hour, arrivals, present)
+		VALUES (NEW.iata_code, strftime('%s', NEW.arrive) / 3600, 1, 0)
+		ON CONFLICT (iata_code, hour) DO UPDATE SET arrivals = arrivals + 1;
+	INSERT INTO airport_hours (iata_code, hour, arrivals, present)
+		SELECT NEW.iata_code, strftime('%s', NEW.arrive) / 3600 + n, 0, 1
+		FROM hour_offsets
+		WHERE n < (strftime('%s', NEW.depart) + 3599) / 3600 - strftime('%s', NEW.arrive) / 3600
+		ON CONFLICT (iata_code, hour) DO UPDATE SET present = present + 1;
+END;
+
 CREATE TABLE IF NOT EXISTS assets (
 	hash TEXT PRIMARY KEY,
 	name TEXT NOT NULL,
@@ -0,0 +1,276 @@
+import json
+import math
+import base64
+from typing import Literal, NamedTuple, cast, get_args
+
+from datetime import date as Date
+
+import httputil
+from flights import fetch_flights, SEARCH_CACHE
+from models import FlightApiResponse
+from layovers import get_decayed_popularity, get_window_popularity, hour_of
+
+# Search results are stored one row per itinerary in the cache database, in
+# the order flights.fetch_flights ranked them. Each search also has a regular
+# cache entry holding its metadata, which the rows reference: when the entry
+# expires, is evicted or is replaced by a refresh, its rows go with it.
+httputil.db.executescript(
+    """
+    CREATE TABLE IF NOT EXISTS search_results (
+        search BLOB NOT NULL REFERENCES cache(key) ON DELETE CASCADE,
+        rank INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        layover_hours REAL,
+        price REAL NOT NULL,
+        stops TEXT NOT NULL,
+        PRIMARY KEY (search, rank)
+    );
+
+    CREATE INDEX IF NOT EXISTS search_results_price
+        ON search_results (search, price, rank);
+    """
+)
+__columns = [
+    row["name"] for row in httputil.db.execute("PRAGMA table_info(search_results)")
+]
+if "windows" not in __columns:
+    # When each itinerary is at its stops, as JSON [iata, first hour, last
+    # hour] triples. Rows from before this column existed have no companions.
+    httputil.db.execute("ALTER TABLE search_results ADD COLUMN windows TEXT")
+httputil.db.commit()
+
+# popularity ranks by how popular the stops are around now; companions ranks
+# by how many people are at the stops at the same time as the itinerary.
+Sort = Literal["layover_hours", "price", "popularity", "companions"]
+
+
+class Cursor(NamedTuple):
+    """
+    Where a page ended: the sort key and rank of its last itinerary. The next
+    page starts right after it, so itineraries aren't skipped or repeated
+    between pages the way they can be with page numbers.
+    """
+
+    sort: Sort
+    value: float
+    rank: int
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(json.dumps(self).encode()).decode()
+
+    @classmethod
+    def decode(cls, s: str) -> "Cursor":
+        try:
+            sort, value, rank = json.loads(base64.urlsafe_b64decode(s))
+        except Exception:
+            raise ValueError("invalid cursor")
+        if sort not in get_args(Sort):
+            raise ValueError("invalid cursor")
+        return cls(sort, float(value), int(rank))
+
+
+def key(origin: str, dest: str, date: Date, return_date: Date) -> dict:
+    """
+    Returns the cache key of a search.
+    """
+    return {
+        "origin": origin,
+        "dest": dest,
+        "date": str(date),
+        "return_date": str(return_date),
+    }
+
+
+async def fetch(
+    origin: str,
+    dest: str,
+    date: Date,
+    return_date: Date,
+    num_adults: int,
+    wait_time: int,
+    user_id: str,
+) -> FlightApiResponse:
+    """
+    Searches upstream and caches the results. Callers should coalesce this
+    through flights.flight_searches.
+    """
+    search = await fetch_flights(
+        origin, dest, date, return_date, num_adults, wait_time, user_id
+    )
+    if search.status:
+        store(key(origin, dest, date, return_date), search, SEARCH_CACHE)
+    return search
+
+
+def __stops(flight) -> str:
+    return ",".join(
+        stop.display_code
+        for leg in flight.legs or []
+        for stop in leg.stops or []
+        if stop.display_code is not None
+    )
+
+
+def __windows(flight) -> str:
+    # Upstream doesn't say when an itinerary gets to or leaves a stop, only
+    # when its leg does, so it could be at any of the leg's stops then.
+    return json.dumps(
+        [
+            [stop.display_code, hour_of(leg.departure), hour_of(leg.arrival)]
+            for leg in flight.legs or []
+            for stop in leg.stops or []
+            if stop.display_code is not None
+        ]
+    )
+
+
+def store(key: dict, search: FlightApiResponse, namespace: httputil.Namespace):
+    """
+    Caches a ranked search, replacing any earlier results for the same key.
+    """
+    header = {
+        "status": search.status,
+        "message": search.message,
+        "timestamp": search.timestamp,
+        "count": len(search.data or []),
+    }
+    httputil.set_cache(key, json.dumps(header), namespace, header)
+
+    searchkey = httputil.digest(key)
+    httputil.db.executemany(
+        """
+        INSERT INTO search_results
+            (search, rank, id, layover_hours, price, stops, windows)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (
+                searchkey,
+                rank,
+                flight.id,
+                flight.layover_hours,
+                flight.price.amount if flight.price.amount is not None else math.inf,
+                __stops(flight),
+                __windows(flight),
+            )
+            for rank, flight in enumerate(search.data or [])
+        ),
+    )
+    httputil.db.commit()
+
+
+def get(key: dict, namespace: httputil.Namespace) -> httputil.CacheEntry | None:
+    """
+    Looks up a cached search. The entry's value is its metadata, including
+    the number of itineraries as count.
+    """
+    entry = httputil.get_cached_entry(key, namespace, json.loads)
+    # Searches cached before they were stored by rank are refetched.
+    if entry is None or "count" not in entry.value:
+        return None
+    return entry
+
+
+def page(
+    key: dict,
+    sort: Sort,
+    limit: int,
+    offset: int = 0,
+    after: Cursor | None = None,
+) -> tuple[list[str], Cursor | None]:
+    """
+    Returns the itinerary IDs of one page of a cached search, either offset
+    itineraries in or right after the given cursor, and the cursor for the
+    page after it if there is one.
+    """
+    searchkey = httputil.digest(key)
+
+    if sort in ("popularity", "companions"):
+        if sort == "popularity":
+            rows = __by_popularity(searchkey)
+        else:
+            rows = __by_companions(searchkey)
+        if after is not None:
+            rows = [r for r in rows if (-r[0], r[1]) > (-after.value, after.rank)]
+        rows = rows[offset : offset + limit + 1]
+    else:
+        # Ranks are already by layover hours, best first.
+        column = "rank" if sort == "layover_hours" else "price"
+        if after is None:
+            after = Cursor(sort, -math.inf, -1)
+        rows = httputil.db.execute(
+            f"""
+            SELECT {column}, rank, id FROM search_results
+            WHERE search = ? AND ({column}, rank) > (?, ?)
+            ORDER BY {column}, rank
+            LIMIT ? OFFSET ?
+            """,
+            (searchkey, after.value, after.rank, limit + 1, offset),
+        ).fetchall()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    next = None
+    if more:
+        value, rank, _ = rows[-1]
+        next = Cursor(sort, value, rank)
+
+    return [row[2] for row in rows], next
+
+
+def top(key: dict, limit: int) -> list[tuple[str, float | None, float | None]]:
+    """
+    Returns the ID, layover hours and price of the best ranked itineraries of
+    a cached search.
+    """
+    rows = httputil.db.execute(
+        """
+        SELECT id, layover_hours, price FROM search_results
+        WHERE search = ? ORDER BY rank LIMIT ?
+        """,
+        (httputil.digest(key), limit),
+    )
+    return [
+        (id, hours, price if price != math.inf else None) for id, hours, price in rows
+    ]
+
+
+def __by_popularity(searchkey: bytes) -> list[tuple[float, int, str]]:
+    # Popularity changes as people add layovers, so it can't be stored with
+    # the rows; rank the whole search by it, most popular first.
+    rows = httputil.db.execute(
+        "SELECT rank, id, stops FROM search_results WHERE search = ?",
+        (searchkey,),
+    ).fetchall()
+
+    stops = [cast(str, row["stops"]).split(",") if row["stops"] else [] for row in rows]
+    popularity = get_decayed_popularity(iata for codes in stops for iata in codes)
+
+    ranked = [
+        (float(sum(popularity.get(iata, 0) for iata in codes)), row["rank"], row["id"])
+        for row, codes in zip(rows, stops)
+    ]
+    ranked.sort(key=lambda r: (-r[0], r[1]))
+    return ranked
+
+
+def __by_companions(searchkey: bytes) -> list[tuple[float, int, str]]:
+    # Same as __by_popularity, but only counting the people at each stop
+    # while the itinerary could be.
+    rows = httputil.db.execute(
+        "SELECT rank, id, windows FROM search_results WHERE search = ?",
+        (searchkey,),
+    ).fetchall()
+
+    windows = [
+        [tuple(w) for w in json.loads(row["windows"])] if row["windows"] else []
+        for row in rows
+    ]
+    scores = get_window_popularity(windows)
+
+    ranked = [
+        (float(score), row["rank"], row["id"]) for row, score in zip(rows, scores)
+    ]
+    ranked.sort(key=lambda r: (-r[0], r[1]))
+    return ranked
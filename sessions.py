@@ -0,0 +1,232 @@
+import time
+import asyncio
+import secrets
+from datetime import date as Date
+from typing import cast
+
+import budget
+import httputil
+import searches
+from flights import fetch_flights, flight_searches, SEARCH_CACHE
+from models import Flight, FlightApiResponse, SearchSession
+
+# The first poll only waits this long upstream so the first results come back
+# fast; later polls wait longer, which lets upstream find more.
+FIRST_WAIT_TIME = 300  # ms
+POLL_WAIT_TIME = 3000  # ms
+POLL_INTERVAL = 2.0  # seconds between polls
+
+# A session is done once a poll turns up no new itineraries, or after this
+# many polls since each one costs a search from the monthly budget.
+MAX_POLLS = 5
+
+# How long finished sessions can still be looked up.
+SESSION_TTL = 10 * 60
+
+
+class Session:
+    """
+    A search that keeps polling upstream in the background, merging what each
+    poll finds into the cached search until the results stop changing.
+    """
+
+    def __init__(
+        self,
+        origin: str,
+        dest: str,
+        date: Date,
+        return_date: Date,
+        num_adults: int,
+        user_id: str,
+    ):
+        self.id = secrets.token_urlsafe(12)
+        self.origin = origin
+        self.dest = dest
+        self.date = date
+        self.return_date = return_date
+        self.num_adults = num_adults
+        self.user_id = user_id
+
+        self.flights: dict[str, Flight] = {}
+        self.version = 0
+        self.polls = 0
+        self.complete = False
+        self.error: str | None = None
+        self.updated = time.time()
+        self.changed = asyncio.Condition()
+        self.first: asyncio.Task | None = None
+        self.task: asyncio.Task | None = None
+
+    @property
+    def key(self) -> dict:
+        # Same as the key /api/flights caches the search under, so pages of
+        # the session are read from there.
+        return searches.key(self.origin, self.dest, self.date, self.return_date)
+
+    def state(self) -> SearchSession:
+        return SearchSession(
+            id=self.id,
+            origin=self.origin,
+            dest=self.dest,
+            date=self.date,
+            return_date=self.return_date,
+            version=self.version,
+            count=len(self.flights),
+            polls=self.polls,
+            complete=self.complete,
+            error=self.error,
+        )
+
+    async def wait(self, version: int) -> SearchSession:
+        """
+        Waits until the session is past the given version or complete.
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.version > version or self.complete)
+        return self.state()
+
+    async def poll(self, wait_time: int) -> bool:
+        """
+        Polls upstream once and merges the results in. Returns whether there
+        was anything new.
+        """
+        self.polls += 1
+        before = len(self.flights)
+        ran = False
+
+        async def fetch() -> FlightApiResponse:
+            nonlocal ran
+            ran = True
+            search = await fetch_flights(
+                self.origin,
+                self.dest,
+                self.date,
+                self.return_date,
+                self.num_adults,
+                wait_time,
+                self.user_id,
+            )
+            if not search.status:
+                # Upstream didn't get anywhere; keep what we have.
+                return search
+            merged = self.__merge(search)
+            if len(self.flights) > before or self.version == 0:
+                searches.store(self.key, merged, SEARCH_CACHE)
+            return merged
+
+        # Through the same group as /api/flights, so that a session and a plain
+        # search for the same thing share one upstream call. Whoever joins a
+        # poll gets the merged results, which are what's stored.
+        search = await flight_searches.do(self.key, fetch)
+        if not ran and search.status:
+            # This poll joined a plain search, which stored only its own
+            # results over the merged ones.
+            searches.store(self.key, self.__merge(search), SEARCH_CACHE)
+
+        new = len(self.flights) > before
+        if new or self.version == 0:
+            await self.__update()
+
+        return new
+
+    def __merge(self, search: FlightApiResponse) -> FlightApiResponse:
+        for flight in search.data or []:
+            # Later polls have fresher prices, so they win.
+            self.flights[cast(str, flight.id)] = flight
+
+        merged = sorted(
+            self.flights.values(),
+            key=lambda flight: cast(float, flight.layover_hours),
+            reverse=True,
+        )
+        return FlightApiResponse(
+            status=search.status,
+            message=search.message,
+            timestamp=search.timestamp,
+            data=merged,
+        )
+
+    def start(self):
+        self.first = asyncio.ensure_future(self.poll(FIRST_WAIT_TIME))
+        self.first.add_done_callback(self.__started)
+
+    def __started(self, first: asyncio.Task):
+        if first.cancelled() or first.exception() is not None:
+            # Whoever is waiting on the first poll gets its error; there's
+            # nothing to keep polling for.
+            self.complete = True
+            self.__forget()
+        else:
+            self.task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        try:
+            while self.polls < MAX_POLLS and budget.state().mode == "normal":
+                await asyncio.sleep(POLL_INTERVAL)
+                if not await self.poll(POLL_WAIT_TIME):
+                    break
+        except Exception as e:
+            self.error = repr(e)
+            print(f"search session {self.id} failed: {e!r}")
+        finally:
+            self.complete = True
+            await self.__update()
+            asyncio.get_running_loop().call_later(SESSION_TTL, self.__forget)
+
+    async def __update(self):
+        async with self.changed:
+            self.version += 1
+            self.updated = time.time()
+            self.changed.notify_all()
+
+    def __forget(self):
+        sessions.pop(self.id, None)
+        if running.get(httputil.digest(self.key)) is self:
+            del running[httputil.digest(self.key)]
+
+
+# Sessions by ID, and the one still polling for each search so that everyone
+# asking for the same search shares it.
+sessions: dict[str, Session] = {}
+running: dict[bytes, Session] = {}
+
+
+async def start(
+    origin: str,
+    dest: str,
+    date: Date,
+    return_date: Date,
+    num_adults: int,
+    user_id: str,
+) -> Session:
+    """
+    Starts a session for the search, or joins the one already running for it.
+    Returns once the first batch of results is cached.
+    """
+    session = Session(origin, dest, date, return_date, num_adults, user_id)
+
+    existing = running.get(httputil.digest(session.key))
+    if existing is not None and not existing.complete:
+        session = existing
+    else:
+        sessions[session.id] = session
+        running[httputil.digest(session.key)] = session
+        session.start()
+
+    assert session.first is not None
+    # Shielded so that one caller going away doesn't cancel it for the rest.
+    await asyncio.shield(session.first)
+    return session
+
+
+def get(id: str) -> Session | None:
+    return sessions.get(id)
+
+
+def is_running(key: dict) -> bool:
+    """
+    Returns whether a session is still polling for the search with the given
+    cache key, in which case it keeps the cached search up to date itself.
+    """
+    session = running.get(httputil.digest(key))
+    return session is not None and not session.complete
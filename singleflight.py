@@ -0,0 +1,68 @@
+import json
+import asyncio
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from models import CoalescingStats
+
+T = TypeVar("T")
+
+
+def normalize_key(key: dict) -> str:
+    """
+    Returns a string that is the same for equal keys regardless of the order
+    of their fields.
+    """
+    return json.dumps(key, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class Group(Generic[T]):
+    """
+    Coalesces concurrent calls that have the same key: the first caller starts
+    the call and everyone else who asks for the same key while it's in flight
+    waits for that call instead of making their own. All of them get the same
+    result, or the same exception.
+
+    The call runs in its own task, so it still finishes (and e.g. fills the
+    cache) if the caller that started it goes away.
+    """
+
+    def __init__(self):
+        self.calls: dict[str, asyncio.Task[T]] = {}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+
+    async def do(self, key: dict, fn: Callable[[], Awaitable[T]]) -> T:
+        # Shield the shared task so that one caller being cancelled doesn't
+        # cancel it for everyone else.
+        return await asyncio.shield(self.start(key, fn))
+
+    def start(self, key: dict, fn: Callable[[], Awaitable[T]]) -> asyncio.Task[T]:
+        """
+        Starts the call for the given key unless it is already in flight, and
+        returns its task without waiting for it.
+        """
+        keystr = normalize_key(key)
+
+        task = self.calls.get(keystr)
+        if task is not None:
+            self.coalesced_calls += 1
+            return task
+
+        self.upstream_calls += 1
+        task = asyncio.ensure_future(fn())
+        task.add_done_callback(lambda _: self.calls.pop(keystr, None))
+        self.calls[keystr] = task
+        return task
+
+    def is_running(self, key: dict) -> bool:
+        return normalize_key(key) in self.calls
+
+    def in_flight(self) -> int:
+        return len(self.calls)
+
+    def stats(self) -> CoalescingStats:
+        return CoalescingStats(
+            upstream_calls=self.upstream_calls,
+            coalesced_calls=self.coalesced_calls,
+            in_flight=self.in_flight(),
+        )
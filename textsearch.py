@@ -0,0 +1,213 @@
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from typing import Generic, Iterable, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# Minimum trigram similarity (Dice coefficient) for a word to count as a
+# misspelling of another: "hethrow" vs "heathrow" is 0.71, "tokio" vs "tokyo"
+# is 0.5.
+FUZZY_THRESHOLD = 0.45
+
+
+def normalize(s: str) -> str:
+    """
+    Normalizes a string for searching: diacritics are stripped, the string is
+    case-folded and anything that isn't a letter or digit becomes a single
+    space. "Zürich-Kloten" becomes "zurich kloten".
+    """
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c)).casefold()
+    return " ".join("".join(c if c.isalnum() else " " for c in s).split())
+
+
+def trigrams(word: str) -> set[str]:
+    # Padded the same way as PostgreSQL's pg_trgm so that short words and
+    # word starts still produce trigrams.
+    word = f"  {word} "
+    return {word[i : i + 3] for i in range(len(word) - 2)}
+
+
+class SearchIndex(Generic[T]):
+    """
+    An in-memory search index for autocompletion. Each item has a code and a
+    few texts (e.g. a city and a name) and results are ranked in tiers:
+
+        1. exact code matches,
+        2. prefix matches on the code, then on whole texts, then on words,
+        3. substring matches anywhere in the texts,
+        4. fuzzy matches where every query word is close to a word in the
+           texts, for typos.
+
+    Lower tiers are only searched when the higher ones can't fill the limit.
+    """
+
+    __slots__ = (
+        "items",
+        "codes",
+        "prefixes",
+        "texts",
+        "text_trigrams",
+        "vocab",
+        "vocab_trigrams",
+        "vocab_items",
+    )
+
+    items: list[T]
+    codes: dict[str, list[int]]
+    # Sorted (key, item index) lists, one per prefix tier.
+    prefixes: tuple[list[tuple[str, int]], ...]
+    # Normalized texts of each item joined together, for substring matches.
+    texts: list[str]
+    text_trigrams: dict[str, list[int]]
+    # Distinct words across all texts and the trigrams and items for each.
+    vocab: list[tuple[str, set[str]]]
+    vocab_trigrams: dict[str, list[int]]
+    vocab_items: list[list[int]]
+
+    def __init__(self, entries: Iterable[tuple[T, str, Sequence[str]]]):
+        self.items = []
+        self.codes = {}
+        self.texts = []
+        self.text_trigrams = {}
+        self.vocab = []
+        self.vocab_trigrams = {}
+        self.vocab_items = []
+
+        code_prefixes: list[tuple[str, int]] = []
+        text_prefixes: list[tuple[str, int]] = []
+        word_prefixes: list[tuple[str, int]] = []
+        vocab_ids: dict[str, int] = {}
+
+        for i, (item, code, texts) in enumerate(entries):
+            self.items.append(item)
+
+            code = normalize(code)
+            self.codes.setdefault(code, []).append(i)
+            code_prefixes.append((code, i))
+
+            normalized = [t for t in map(normalize, texts) if t]
+            self.texts.append(" ".join([code, *normalized]))
+
+            for text in normalized:
+                text_prefixes.append((text, i))
+
+                # Index every word start, so "angel" finds "los angeles".
+                words = text.split(" ")
+                for j in range(1, len(words)):
+                    word_prefixes.append((" ".join(words[j:]), i))
+
+                for word in words:
+                    if word not in vocab_ids:
+                        vocab_ids[word] = len(self.vocab)
+                        self.vocab.append((word, trigrams(word)))
+                        self.vocab_items.append([])
+                        for trigram in self.vocab[-1][1]:
+                            self.vocab_trigrams.setdefault(trigram, []).append(
+                                vocab_ids[word]
+                            )
+
+                    postings = self.vocab_items[vocab_ids[word]]
+                    if not postings or postings[-1] != i:
+                        postings.append(i)
+
+            for trigram in {t for w in self.texts[i].split(" ") for t in trigrams(w)}:
+                self.text_trigrams.setdefault(trigram, []).append(i)
+
+        self.prefixes = (
+            sorted(code_prefixes),
+            sorted(text_prefixes),
+            sorted(word_prefixes),
+        )
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def search(self, query: str, limit=10) -> list[T]:
+        q = normalize(query)
+        if not q or limit <= 0:
+            return []
+
+        found: dict[int, None] = {}  # insertion-ordered set
+
+        def add(indices: Iterable[int]) -> bool:
+            for i in indices:
+                found.setdefault(i, None)
+                if len(found) >= limit:
+                    return True
+            return False
+
+        tiers = (
+            self.codes.get(q, []),
+            *(self.__prefixed(keys, q) for keys in self.prefixes),
+            self.__containing(q),
+            self.__fuzzy(q),
+        )
+
+        # The tiers are lazy, so we stop searching as soon as we have enough.
+        for tier in tiers:
+            if add(tier):
+                break
+
+        return [self.items[i] for i in found]
+
+    def __prefixed(self, keys: list[tuple[str, int]], q: str):
+        # Keys are sorted, so all keys starting with q are in one run and come
+        # out alphabetically.
+        for j in range(bisect_left(keys, (q,)), len(keys)):
+            key, i = keys[j]
+            if not key.startswith(q):
+                break
+            yield i
+
+    def __containing(self, q: str):
+        grams = set().union(*(trigrams(w) for w in q.split(" ")))
+        # Trigrams of the query's first and last word are padded as if they
+        # were whole words, which isn't true for a substring; drop those.
+        grams = {g for g in grams if " " not in g}
+        if not grams:
+            # Too short to have any; there's nothing to narrow down by, so
+            # check every item.
+            for i, text in enumerate(self.texts):
+                if q in text:
+                    yield i
+            return
+
+        postings = sorted((self.text_trigrams.get(g, []) for g in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        for i in sorted(candidates):
+            if q in self.texts[i]:
+                yield i
+
+    def __fuzzy(self, q: str):
+        # Every query word has to be similar to some word of the item; items
+        # are ranked by their total similarity.
+        scores: Counter[int] | None = None
+
+        for word in q.split(" "):
+            grams = trigrams(word)
+
+            shared: Counter[int] = Counter()
+            for g in grams:
+                shared.update(self.vocab_trigrams.get(g, []))
+
+            best: dict[int, float] = {}
+            for v, n in shared.items():
+                sim = 2 * n / (len(grams) + len(self.vocab[v][1]))
+                if sim < FUZZY_THRESHOLD:
+                    continue
+                for i in self.vocab_items[v]:
+                    best[i] = max(best.get(i, 0), sim)
+
+            if scores is None:
+                scores = Counter(best)
+            else:
+                scores = Counter({i: scores[i] + s for i, s in best.items() if i in scores})
+
+            if not scores:
+                return
+
+        assert scores is not None
+        for i, _ in scores.most_common():
+            yield i
@@ -0,0 +1,297 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Callable, NamedTuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from fastapi import HTTPException
+
+from models import LatencyStats, UpstreamStats
+
+# Connection pool. RapidAPI is a single host, so most of the pool goes to it;
+# idle connections are kept around for a while to save TLS handshakes.
+POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 32))
+POOL_SIZE_PER_HOST = int(os.environ.get("UPSTREAM_POOL_SIZE_PER_HOST", 16))
+KEEPALIVE_TIMEOUT = 60  # seconds
+DNS_CACHE_TTL = 5 * 60  # seconds
+
+# Timeouts, in seconds. A call that takes longer than TIMEOUT in total is
+# given up on even if it's still making progress.
+TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 20))
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15  # between reads of the response
+
+# Retries for failed calls, after a random delay of up to RETRY_BACKOFF
+# doubled for every retry so far.
+RETRIES = 2
+RETRY_BACKOFF = 0.25  # seconds
+RETRY_STATUSES = {500, 502, 503, 504}
+
+# The circuit breaker opens after this many calls in a row fail, and then
+# fails calls right away for BREAKER_COOLDOWN seconds before letting one
+# through to see if upstream is back.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# Hedged calls send a second identical request if the first one is slower
+# than most (p95) calls to the same endpoint, and use whichever answers
+# first. Every request counts against the monthly quota, so this is opt-in.
+HEDGE = os.environ.get("UPSTREAM_HEDGE", "") not in ("", "0", "false")
+HEDGE_DELAY = 2.0  # seconds, until there are enough latencies to go by
+HEDGE_MIN_SAMPLES = 20
+
+# Latencies kept per endpoint for percentiles.
+LATENCY_SAMPLES = 1000
+
+
+class Response(NamedTuple):
+    status: int
+    ok: bool
+    text: str
+
+
+class __Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial = False  # whether a call is testing a half-open breaker
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def record(self, ok: bool):
+        self.trial = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return
+
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD or self.opened_at is not None:
+            # Failing the half-open trial starts the cooldown over.
+            if self.opened_at is None:
+                self.opens += 1
+            self.opened_at = time.monotonic()
+
+
+breaker = __Breaker()
+
+client: ClientSession | None = None
+
+latencies: dict[str, deque[float]] = {}
+counters = {
+    "requests": 0,
+    "retries": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "errors": 0,
+    "rejected": 0,
+}
+in_flight = 0
+
+
+async def start():
+    """
+    Opens the connection pool. Called from the app's lifespan; calls made
+    before it open the pool themselves.
+    """
+    global client
+    if client is not None and not client.closed:
+        return
+
+    client = ClientSession(
+        connector=TCPConnector(
+            limit=POOL_SIZE,
+            limit_per_host=POOL_SIZE_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        ),
+        timeout=ClientTimeout(
+            total=TIMEOUT,
+            sock_connect=CONNECT_TIMEOUT,
+            sock_read=READ_TIMEOUT,
+        ),
+    )
+
+
+async def close():
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+
+async def get(
+    name: str,
+    url: str,
+    headers: dict,
+    params: dict,
+    cost: Callable[[], None] | None = None,
+    hedge: bool = False,
+) -> Response:
+    """
+    Makes an idempotent GET request upstream, retrying it if it fails, and
+    returns the response once its body is read. name identifies the endpoint
+    in metrics. cost is called for every request actually sent, including
+    retries and hedges. Raises an HTTPException with status 503 while
+    upstream is considered down.
+    """
+    if not breaker.allow():
+        counters["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Flight data provider is unavailable, try again later",
+            headers={"Retry-After": str(BREAKER_COOLDOWN)},
+        )
+
+    def attempt():
+        if hedge and HEDGE:
+            return __hedged(name, url, headers, params, cost)
+        return __request(name, url, headers, params, cost)
+
+    try:
+        for retry in range(RETRIES + 1):
+            if retry > 0:
+                counters["retries"] += 1
+                await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** (retry - 1)))
+
+            try:
+                res = await attempt()
+            except (ClientError, asyncio.TimeoutError):
+                if retry == RETRIES:
+                    raise
+                continue
+
+            if res.status not in RETRY_STATUSES or retry == RETRIES:
+                break
+    except (ClientError, asyncio.TimeoutError):
+        counters["errors"] += 1
+        breaker.record(False)
+        raise
+    except BaseException:
+        # Cancellation, a body that doesn't decode or a cost callback that
+        # refuses the call aren't upstream's fault, so they don't count
+        # either way, but they mustn't leave a half-open trial hanging.
+        breaker.trial = False
+        raise
+
+    ok = res.status not in RETRY_STATUSES
+    if not ok:
+        counters["errors"] += 1
+    breaker.record(ok)
+    return res
+
+
+async def __request(
+    name: str,
+    url: str,
+    headers: dict,
+    params: dict,
+    cost: Callable[[], None] | None,
+) -> Response:
+    global in_flight
+
+    if client is None or client.closed:
+        await start()
+    assert client is not None
+
+    if cost is not None:
+        cost()
+
+    counters["requests"] += 1
+    in_flight += 1
+    start_time = time.perf_counter()
+    try:
+        async with client.get(url, headers=headers, params=params) as res:
+            text = await res.text()
+    finally:
+        in_flight -= 1
+
+    samples = latencies.setdefault(name, deque(maxlen=LATENCY_SAMPLES))
+    samples.append(time.perf_counter() - start_time)
+
+    return Response(res.status, res.ok, text)
+
+
+async def __hedged(
+    name: str,
+    url: str,
+    headers: dict,
+    params: dict,
+    cost: Callable[[], None] | None,
+) -> Response:
+    first = asyncio.ensure_future(__request(name, url, headers, params, cost))
+    pending = {first}
+
+    samples = latencies.get(name, ())
+    delay = HEDGE_DELAY
+    if len(samples) >= HEDGE_MIN_SAMPLES:
+        delay = __percentile(sorted(samples), 0.95)
+
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+
+        counters["hedged"] += 1
+        second = asyncio.ensure_future(__request(name, url, headers, params, cost))
+        pending.add(second)
+
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Use the first one that worked; if both failed, the last failure
+            # is what's raised.
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        counters["hedge_wins"] += 1
+                    return task.result()
+            if not pending:
+                return done.pop().result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def __percentile(sorted_samples: list[float], p: float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(p * len(sorted_samples)))]
+
+
+def stats() -> UpstreamStats:
+    latency = {}
+    for name, samples in latencies.items():
+        ordered = sorted(samples)
+        latency[name] = LatencyStats(
+            count=len(ordered),
+            p50=__percentile(ordered, 0.50) * 1000,
+            p95=__percentile(ordered, 0.95) * 1000,
+            p99=__percentile(ordered, 0.99) * 1000,
+        )
+
+    connector = client.connector if client is not None else None
+    return UpstreamStats(
+        **counters,
+        in_flight=in_flight,
+        breaker=breaker.state,
+        breaker_opens=breaker.opens,
+        pool_limit=POOL_SIZE,
+        pool_in_use=len(connector._acquired) if connector is not None else 0,
+        latency=latency,
+    )